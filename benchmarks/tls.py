@@ -0,0 +1,99 @@
+"""
+Benchmarks bulk transfers over a pair of AioTlsSockets.
+
+usage: python -m benchmarks.tls [MiB] [write KiB] [write window ms]
+
+One socket sends MiB mebibytes in writes of the given size, the other one
+receives them in chunks like a Tunnel does. Reported are the throughput and
+the calls to the underlying sockets (each one is about one syscall).
+"""
+import asyncio
+import os
+import socket
+import ssl
+import sys
+import time
+
+from typing import List
+
+from tmmp.aiosock import AioSocket, AioTlsSocket
+from tmmp.tunnel import Tunnel
+
+from .tunnel import connected_pair
+from .workers import upstream_certificate
+
+
+class CountingSocket(AioSocket):
+    """Counts the reads and writes of the wrapped socket."""
+    reads = 0
+    writes = 0
+
+    async def recv_into(self, buffer) -> int:
+        self.reads += 1
+        return await super().recv_into(buffer)
+
+    async def sendall(self, data):
+        self.writes += 1
+        await super().sendall(data)
+
+
+async def bulk(mebibytes: int, write_size: int, write_window: float):
+    loop = asyncio.get_event_loop()
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    sender_socket, receiver_socket = connected_pair(listener)
+    listener.close()
+
+    certificate = upstream_certificate()
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(certificate)
+    os.unlink(certificate)
+
+    # Only passed if set, so the benchmark runs against older versions too.
+    options = {"write_window": write_window} if write_window else {}
+    raw_sender = CountingSocket(sender_socket, loop=loop)
+    raw_receiver = CountingSocket(receiver_socket, loop=loop)
+    sender = AioTlsSocket(raw_sender, ssl._create_unverified_context(),
+                          server_hostname="benchmark", loop=loop, **options)
+    receiver = AioTlsSocket(raw_receiver, server_context, True, loop=loop)
+    await asyncio.gather(sender.handshake(), receiver.handshake())
+    raw_sender.writes = raw_receiver.reads = 0
+
+    total = mebibytes * 2 ** 20
+    chunk = b"\x00" * write_size
+
+    async def send():
+        for _ in range(total // len(chunk)):
+            await sender.sendall(chunk)
+
+    async def receive():
+        buffer = bytearray(Tunnel.chunk_size)
+        received = 0
+        while received < total:
+            received += await receiver.recv_into(buffer)
+
+    start = time.monotonic()
+    await asyncio.gather(send(), receive())
+    elapsed = time.monotonic() - start
+
+    print(f"{mebibytes} MiB in {write_size // 1024} KiB writes "
+          f"(window {write_window * 1000:g} ms): "
+          f"{total * 8 / elapsed / 1e6:.1f} Mbit/s, "
+          f"{raw_sender.writes} socket writes, "
+          f"{raw_receiver.reads} socket reads")
+
+    sender_socket.close()
+    receiver_socket.close()
+
+
+def main(argv: List[str] = sys.argv):
+    asyncio.get_event_loop().run_until_complete(bulk(
+        int(argv[1]) if len(argv) > 1 else 64,
+        (int(argv[2]) if len(argv) > 2 else 1) * 1024,
+        (float(argv[3]) if len(argv) > 3 else 0) / 1000
+    ))
+
+
+if __name__ == "__main__":
+    main()
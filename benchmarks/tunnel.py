@@ -0,0 +1,171 @@
+"""
+Benchmarks for the tunnel data path.
+
+usage: python -m benchmarks.tunnel (idle [tunnels] [seconds] |
+                                   bulk [MiB] [capture|capture-file|
+                                               capture-gzip|capture-zstd|
+                                               capture-sidecar|nocapture|
+                                               passthrough])
+
+"idle" opens many tunnels without traffic and reports the CPU time used per
+second of wall time, "bulk" pushes data through a single tunnel and reports
+the throughput (by default with capture into memory, "capture-file" goes
+through the capture queue into a temporary directory, "capture-gzip" and
+"capture-zstd" compress the files, "capture-sidecar" leaves all of that to a
+sidecar process). The CPU time is the one of the benchmark process, which
+includes the sending and receiving end but not the sidecar. Both use TCP
+connections over the loopback interface.
+"""
+import asyncio
+import socket
+import sys
+import time
+
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import List, Optional, Tuple
+
+from tmmp.aiosock import AioSocket
+from tmmp.capture import CaptureWriter
+from tmmp.capture_sidecar import SidecarCapture
+from tmmp.pcap import PcapStream, RecordSink
+from tmmp.tunnel import Tunnel
+
+
+def connected_pair(listener: socket.socket) -> Tuple[socket.socket,
+                                                     socket.socket]:
+    outer = socket.create_connection(listener.getsockname())
+    inner, _ = listener.accept()
+    return outer, inner
+
+
+def open_tunnels(count: int, loop: asyncio.AbstractEventLoop,
+                 mode: str = "nocapture",
+                 write_to: Optional[RecordSink] = None) \
+        -> List[Tuple[socket.socket, socket.socket]]:
+    """Returns the (client, server) endpoints of the scheduled tunnels."""
+    if write_to is None and mode == "capture":
+        write_to = PcapStream(BytesIO())
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1024)
+
+    endpoints = []
+    for _ in range(count):
+        client, proxy_client = connected_pair(listener)
+        server, proxy_server = connected_pair(listener)
+
+        Tunnel(AioSocket(proxy_client, loop=loop),
+               AioSocket(proxy_server, loop=loop), loop=loop,
+               write_to=write_to,
+               passthrough=mode == "passthrough").schedule()
+        client.setblocking(False)
+        server.setblocking(False)
+        endpoints.append((client, server))
+
+    listener.close()
+    return endpoints
+
+
+async def idle(tunnels: int, seconds: float):
+    loop = asyncio.get_event_loop()
+    endpoints = open_tunnels(tunnels, loop)
+    await asyncio.sleep(.5)  # Let the tunnels settle
+
+    cpu, wall = time.process_time(), time.monotonic()
+    await asyncio.sleep(seconds)
+    cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+
+    print(f"{tunnels} idle tunnels: {cpu / wall * 100:.1f}% CPU "
+          f"({cpu:.3f}s CPU in {wall:.1f}s)")
+
+    for client, server in endpoints:
+        client.close()
+        server.close()
+
+
+async def bulk(mebibytes: int, mode: str):
+    loop = asyncio.get_event_loop()
+    capture, directory = None, None
+    if mode == "capture-sidecar":
+        directory = TemporaryDirectory()
+        capture = SidecarCapture({"directory": directory.name})
+        writer_task = loop.create_task(capture.run())
+        await capture.wait_attached()
+    elif mode.startswith("capture-"):
+        compression = mode[len("capture-"):]
+        directory = TemporaryDirectory()
+        capture = CaptureWriter(
+            directory.name,
+            compression="none" if compression == "file" else compression)
+        writer_task = loop.create_task(capture.run())
+
+    (client, server), = open_tunnels(1, loop, mode, capture)
+    total = mebibytes * 2 ** 20
+    chunk = b"\x00" * 2 ** 16
+
+    async def send():
+        for _ in range(total // len(chunk)):
+            await loop.sock_sendall(client, chunk)
+
+    async def receive():
+        received = 0
+        while received < total:
+            received += len(await loop.sock_recv(server, 2 ** 16))
+
+    start, cpu = time.monotonic(), time.process_time()
+    await asyncio.gather(send(), receive())
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    print(f"bulk ({mode}): {mebibytes} MiB in {elapsed:.2f}s = "
+          f"{total * 8 / elapsed / 1e6:.1f} Mbit/s, {cpu:.2f}s CPU")
+
+    client.close()
+    server.close()
+
+    if capture is None:
+        return
+
+    if mode == "capture-sidecar":
+        # Lets the sidecar catch up, stopping the capture makes it exit.
+        await capture.drain()
+        writer_task.cancel()
+        await asyncio.gather(writer_task, return_exceptions=True)
+        await loop.run_in_executor(None, capture.process.wait)
+        files = list(Path(directory.name).iterdir())
+        print(f"sidecar wrote {sum(f.stat().st_size for f in files)} bytes "
+              f"in {len(files)} file(s), dropped {capture.dropped_bytes} "
+              f"bytes")
+    else:
+        writer_task.cancel()
+        await asyncio.gather(writer_task, return_exceptions=True)
+        on_disk = sum(f.stat().st_size for f in capture.directory.iterdir())
+        print(f"captured {capture.written_bytes} bytes in {capture.files} "
+              f"file(s) ({on_disk} bytes on disk), "
+              f"dropped {capture.dropped_bytes} bytes")
+    directory.cleanup()
+
+
+def main(argv: List[str] = sys.argv):
+    if len(argv) < 2 or argv[1] not in ("idle", "bulk"):
+        print(__doc__)
+        sys.exit(-1)
+
+    loop = asyncio.get_event_loop()
+    if argv[1] == "idle":
+        loop.run_until_complete(idle(
+            int(argv[2]) if len(argv) > 2 else 1000,
+            float(argv[3]) if len(argv) > 3 else 5.0
+        ))
+    else:
+        loop.run_until_complete(bulk(
+            int(argv[2]) if len(argv) > 2 else 64,
+            argv[3] if len(argv) > 3 else "capture"
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Benchmarks the scaling of intercepted TLS connections with worker processes.
+
+usage: python -m benchmarks.workers [max_workers] [connections] [KiB]
+
+For 1 to max_workers (default: CPU count) workers, the proxy is started with
+SOCKS and TLS interception (capture disabled). As many client processes as
+there are CPUs open the given count of connections through it, each doing a
+TLS handshake and echoing KiB kilobytes over it. The upstream is a local TLS
+echo server.
+"""
+import asyncio
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from multiprocessing import Pool, Process
+from typing import List
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import \
+    Encoding, PrivateFormat, NoEncryption
+from cryptography.x509.oid import NameOID
+
+CONFIG = """\
+[server]
+listen = "::1"
+port = {port}
+workers = {workers}
+
+[proxy]
+protocol = "socks"
+
+[application]
+protocols = [ "tls" ]
+
+[capture]
+enabled = false
+"""
+
+
+def free_port(family: int = socket.AF_INET6) -> int:
+    with socket.socket(family) as s:
+        s.bind(("::1" if family == socket.AF_INET6 else "127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def upstream_certificate() -> str:
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "upstream")])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(
+        name
+    ).public_key(
+        key.public_key()
+    ).serial_number(1).not_valid_before(
+        datetime.utcnow()
+    ).not_valid_after(
+        datetime.utcnow() + timedelta(days=1)
+    ).sign(key, hashes.SHA256(), default_backend())
+
+    with tempfile.NamedTemporaryFile("wb", suffix=".pem",
+                                     delete=False) as file:
+        file.write(cert.public_bytes(Encoding.PEM))
+        file.write(key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8,
+                                     NoEncryption()))
+        return file.name
+
+
+def upstream(port: int, certificate: str):
+    """TLS echo server, one per CPU sharing the port."""
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(2 ** 16)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certificate)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.start_server(
+        echo, "127.0.0.1", port, ssl=context, reuse_port=True))
+    loop.run_forever()
+
+
+def client(arguments) -> int:
+    """Does one intercepted connection, returns the count of echoed bytes."""
+    proxy_port, upstream_port, size = arguments
+
+    with socket.create_connection(("::1", proxy_port)) as s:
+        s.sendall(b"\x05\x01\x00")
+        s.recv(2)
+        s.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") +
+                  struct.pack("!H", upstream_port))
+        s.recv(1024)
+
+        context = ssl._create_unverified_context()
+        with context.wrap_socket(s, server_hostname="example.com") as tls:
+            payload = b"\x00" * size
+            tls.sendall(payload)
+            received = 0
+            while received < size:
+                received += len(tls.recv(2 ** 16))
+            return received
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("::1", port)).close()
+            return
+        except OSError:
+            time.sleep(.2)
+    raise TimeoutError(f"Nothing is listening on port {port}.")
+
+
+def run(workers: int, connections: int, size: int, upstream_port: int):
+    port = free_port()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".toml",
+                                     delete=False) as config:
+        config.write(CONFIG.format(port=port, workers=workers))
+
+    proxy = subprocess.Popen([sys.executable, "-m", "tmmp", config.name],
+                             stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+
+        with Pool(os.cpu_count()) as clients:
+            start = time.monotonic()
+            total = sum(clients.map(
+                client, [(port, upstream_port, size)] * connections))
+            elapsed = time.monotonic() - start
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        os.unlink(config.name)
+
+    print(f"{workers} worker(s): {connections / elapsed:.1f} connections/s, "
+          f"{total * 8 / elapsed / 1e6:.1f} Mbit/s")
+
+
+def main(argv: List[str] = sys.argv):
+    max_workers = int(argv[1]) if len(argv) > 1 else os.cpu_count()
+    connections = int(argv[2]) if len(argv) > 2 else 200
+    size = (int(argv[3]) if len(argv) > 3 else 256) * 1024
+
+    upstream_port = free_port(socket.AF_INET)
+    certificate = upstream_certificate()
+    servers = [Process(target=upstream, args=(upstream_port, certificate),
+                       daemon=True)
+               for _ in range(os.cpu_count())]
+    for server in servers:
+        server.start()
+
+    try:
+        for workers in range(1, max_workers + 1):
+            run(workers, connections, size, upstream_port)
+    finally:
+        for server in servers:
+            server.terminate()
+        os.unlink(certificate)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,15 +29,60 @@ class AbstractAioSocket(ABC):
         ...
 
     @abstractmethod
-    async def sendall(self, data: bytes) -> None:
+    async def recv_into(self, buffer: Union[bytearray, memoryview]) -> int:
         """
-        Send data. Guarantees all data is really sent.
+        Receive data into a writable buffer, without allocating new bytes.
 
-        :param data: The Date to send.
+        :param buffer: Buffer to fill, at most len(buffer) bytes are received.
+        :return: Count of received bytes, 0 on EOF.
+        """
+        ...
+
+    @abstractmethod
+    async def wait_readable(self) -> None:
+        """
+        Wait until recv() can make progress. No data is consumed.
+
+        :return: None.
+        """
+        ...
+
+    @abstractmethod
+    def interrupt_wait(self) -> None:
+        """
+        Wake up a pending wait_readable() call, even if no data arrived.
+
+        :return: None.
+        """
+        ...
+
+    @abstractmethod
+    async def sendall(self, data: Union[bytes, memoryview]) -> None:
+        """
+        Send data. Guarantees all data is really sent, sockets holding back
+        writes send it on flush() at the latest.
+
+        :param data: The Date to send, any bytes-like object is accepted.
         :return: None.
         """
         ...
 
+    async def flush(self) -> None:
+        """
+        Send data held back by sendall(). A no-op for most sockets.
+
+        :return: None.
+        """
+
+    async def shutdown(self) -> None:
+        """
+        Flush and tell the peer that no more data follows, without waiting
+        for its answer. Only flushes for most sockets.
+
+        :return: None.
+        """
+        await self.flush()
+
     @abstractmethod
     def get_real_socket(self) -> socket:
         """
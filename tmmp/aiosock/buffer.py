@@ -0,0 +1,52 @@
+"""
+Reusable receive buffers.
+
+Every event loop has its own pool, so no locking is needed. Buffers are only
+held while data is in flight, idle sockets do not own any buffer.
+"""
+import asyncio
+
+from typing import List
+from weakref import WeakKeyDictionary
+
+# Large enough for a full TLS record (2^14 bytes plaintext plus the
+# encryption overhead).
+DEFAULT_BUFFER_SIZE = 2 ** 15
+DEFAULT_POOL_LIMIT = 256
+
+
+class BufferPool:
+    buffer_size: int
+    limit: int
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                 limit: int = DEFAULT_POOL_LIMIT):
+        self.buffer_size = buffer_size
+        self.limit = limit
+        self.free: List[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        """Returns a buffer of buffer_size bytes, allocating if none is free."""
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray) -> None:
+        """Returns a buffer to the pool. It must not be used afterwards."""
+        if len(self.free) < self.limit:
+            self.free.append(buffer)
+
+
+_pools: "WeakKeyDictionary[asyncio.AbstractEventLoop, BufferPool]" = \
+    WeakKeyDictionary()
+
+
+def get_buffer_pool(loop: asyncio.AbstractEventLoop = None) -> BufferPool:
+    """Returns the buffer pool of the given (or current) event loop."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = BufferPool()
+    return pool
@@ -0,0 +1,62 @@
+"""
+Cache of TLS sessions for client side connections, so later connections to
+the same server can resume them instead of doing a full handshake.
+"""
+import ssl
+import time
+
+from typing import Hashable, Optional, Tuple
+
+from ..util.lru import LruCache
+
+DEFAULT_SESSION_CACHE_SIZE = 1024
+DEFAULT_SESSION_TTL = 300
+
+
+class SessionCache:
+    """
+    Keeps the latest session per key (e.g. SNI, address and port).
+
+    Sessions can only be resumed with the SSLContext they were created with.
+    Sessions expire after ttl seconds, or earlier if the server said so.
+    """
+    ttl: float
+    # Client handshakes done, with a cached session offered, and resumed.
+    handshakes: int
+    offered: int
+    resumed: int
+
+    def __init__(self, maxsize: int = DEFAULT_SESSION_CACHE_SIZE,
+                 ttl: float = DEFAULT_SESSION_TTL):
+        self.sessions: LruCache[Hashable, Tuple[ssl.SSLSession, float]] = \
+            LruCache(maxsize)
+        self.ttl = ttl
+
+        self.handshakes = 0
+        self.offered = 0
+        self.resumed = 0
+
+    def get(self, key: Hashable) -> Optional[ssl.SSLSession]:
+        entry = self.sessions.get(key)
+        if entry is None:
+            return None
+
+        session, expires = entry
+        if expires <= time.time():
+            del self.sessions[key]
+            return None
+        return session
+
+    def put(self, key: Hashable, session: ssl.SSLSession):
+        expires = min(time.time() + self.ttl, session.time + session.timeout)
+        self.sessions[key] = session, expires
+
+    def record(self, offered: bool, resumed: bool):
+        """Counts a finished handshake."""
+        self.handshakes += 1
+        self.offered += offered
+        self.resumed += resumed
+
+    @property
+    def resumption_rate(self) -> float:
+        return self.resumed / self.handshakes if self.handshakes else 0.0
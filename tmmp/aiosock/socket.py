@@ -1,12 +1,14 @@
 import asyncio
 from socket import socket
-from typing import Tuple
+from typing import Optional, Tuple, Union
 
 from .abc import AbstractAioSocket
 
 
 class AioSocket(AbstractAioSocket):
     connected = False
+    _read_waiter: Optional[asyncio.Future] = None
+    _read_fd: int = -1
 
     def __init__(self, sock: socket = None, *args, loop: asyncio.AbstractEventLoop = None, **kwargs):
         if sock is None:
@@ -44,7 +46,61 @@ class AioSocket(AbstractAioSocket):
         """
         return await self.loop.sock_recv(self.sock, amount)
 
-    async def sendall(self, data: bytes) -> None:
+    async def recv_into(self, buffer: Union[bytearray, memoryview]) -> int:
+        """
+        Receive data into the given buffer.
+
+        :param buffer: Writable buffer.
+        :return: Count of received bytes.
+        """
+        return await self.loop.sock_recv_into(self.sock, buffer)
+
+    async def wait_readable(self) -> None:
+        """
+        Wait until the socket becomes readable.
+
+        Only a reader callback is registered, so no data is lost if the
+        wait gets interrupted.
+
+        :return: None.
+        """
+        if self._read_waiter is not None:
+            raise RuntimeError("wait_readable() is already pending.")
+
+        waiter = self.loop.create_future()
+        self._read_waiter = waiter
+        self._read_fd = self.sock.fileno()
+        self.loop.add_reader(self._read_fd, self.interrupt_wait)
+
+        try:
+            await waiter
+        finally:
+            if waiter is self._read_waiter:  # Cancelled from outside
+                self._remove_read_waiter()
+
+    def interrupt_wait(self) -> None:
+        """
+        Wake up a pending wait_readable() call.
+
+        The reader is removed synchronously, so the socket can be read by
+        somebody else right after this call.
+
+        :return: None.
+        """
+        waiter = self._read_waiter
+        if waiter is None:
+            return
+
+        self._remove_read_waiter()
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def _remove_read_waiter(self):
+        self.loop.remove_reader(self._read_fd)
+        self._read_waiter = None
+        self._read_fd = -1
+
+    async def sendall(self, data: Union[bytes, memoryview]) -> None:
         """
         Send data. Guarantees all data is really sent.
 
@@ -3,10 +3,14 @@ import functools
 import socket
 import ssl
 
-from typing import Tuple
+from typing import Hashable, Optional, Tuple
 
 from tmmp.aiosock.abc import AbstractAioSocket
-from tmmp.util.tls.masterkey import get_ssl_master_key
+from tmmp.aiosock.buffer import get_buffer_pool
+from tmmp.aiosock.session import SessionCache
+
+# Most plaintext bytes a TLS record can hold.
+MAXIMUM_RECORD_SIZE = 2 ** 14
 
 
 class AioTlsSocket(AbstractAioSocket):
@@ -17,33 +21,65 @@ class AioTlsSocket(AbstractAioSocket):
     this Implementation allows a low level way which allows to pre-read packet data,
     before passing them to OpenSSL.
     """
+    # Size of the first read from the socket. Reads grow up to the size of
+    # the pooled buffers while they fill up and shrink again with little
+    # traffic.
     internal_blocksize = 1024
+    # Seconds small writes are held back to be sent in one record.
+    write_window = 0.0
 
     def __init__(self,
                  abstract_socket: AbstractAioSocket,
                  context: ssl.SSLContext = ssl.create_default_context(),
                  server_side: bool = False,
                  server_hostname: str = None,
-                 loop: asyncio.AbstractEventLoop = None):
+                 loop: asyncio.AbstractEventLoop = None,
+                 session_cache: Optional[SessionCache] = None,
+                 session_key: Optional[Hashable] = None,
+                 write_window: Optional[float] = None):
 
         self.incoming = ssl.MemoryBIO()
         self.outgoing = ssl.MemoryBIO()
 
-        self.client_random = None
-        self.master_secret = None
-
         self.abstract_socket = abstract_socket
         self.server_side = server_side
 
-        self.tls: ssl.SSLObject = context.wrap_bio(self.incoming, self.outgoing, server_side, server_hostname)
+        # Client side sessions are resumed from and stored in the cache.
+        self.session_cache = None if server_side else session_cache
+        self.session_key = session_key
+        session = None
+        if self.session_cache is not None:
+            session = self.session_cache.get(session_key)
+        self.session_offered = session is not None
+        self.session_stored = self.session_cache is None
+
+        self.tls: ssl.SSLObject = context.wrap_bio(
+            self.incoming, self.outgoing, server_side, server_hostname,
+            session=session
+        )
 
         self.wrapped = False
+        # Set once _drain() ran into the end of the peer's data. OpenSSL may
+        # have taken the close_notify in with the last record, the socket
+        # will not become readable for it anymore.
+        self.peer_closed = False
 
         if loop is None:
             self.loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
         else:
             self.loop: asyncio.AbstractEventLoop = loop
 
+        self.blocksize = self.internal_blocksize
+        # Keeps the encrypted data of concurrent senders in order.
+        self.send_lock = asyncio.Lock()
+
+        if write_window is not None:
+            self.write_window = write_window
+        self.write_buffer = bytearray()
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # Raised by the next sendall() if a delayed flush failed.
+        self.write_error: Optional[BaseException] = None
+
     async def connect(self, address: Tuple[str, int]):
         await self.abstract_socket.connect(address)
         await self.handshake()
@@ -54,9 +90,29 @@ class AioTlsSocket(AbstractAioSocket):
         Bidirectional calls will occur."""
         if not self.wrapped:
             await self._communicate(self.tls.do_handshake)
-            self.client_random, self.master_secret = get_ssl_master_key(self.tls)
+            # E.g. the last flight of a TLS 1.2 server, which the client
+            # waits for.
+            if self.outgoing.pending:
+                await self._send()
 
             self.wrapped = True
+            if self.session_cache is not None:
+                self.session_cache.record(self.session_offered,
+                                          self.tls.session_reused)
+                self._store_session()
+
+    def _store_session(self):
+        """Puts the session into the cache once it can be resumed.
+
+        With TLS 1.3 that is after the server sent a ticket, which is read
+        after the handshake."""
+        session = self.tls.session
+        if session is None or \
+                (self.tls.version() == "TLSv1.3" and not session.has_ticket):
+            return
+
+        self.session_cache.put(self.session_key, session)
+        self.session_stored = True
 
     async def _communicate(self, action):
         """Does the desired action until SSLWant*Error won't occur anymore.
@@ -77,34 +133,156 @@ class AioTlsSocket(AbstractAioSocket):
                 await self._send()
 
     async def _recv(self):
-        data = await self.abstract_socket.recv(self.internal_blocksize)
-        self.incoming.write(data)
+        pool = get_buffer_pool(self.loop)
+        buffer = pool.acquire()
+        try:
+            blocksize = min(self.blocksize, len(buffer))
+            view = memoryview(buffer)[:blocksize]
+            received = await self.abstract_socket.recv_into(view)
+            if received:
+                self.incoming.write(view[:received])
+            else:
+                # Lets OpenSSL raise instead of asking for more data forever.
+                self.incoming.write_eof()
+
+            if received == blocksize:
+                self.blocksize = min(blocksize * 2, len(buffer))
+            elif received < blocksize // 4:
+                self.blocksize = max(blocksize // 2, self.internal_blocksize)
+        finally:
+            pool.release(buffer)
 
     async def _send(self):
-        data = self.outgoing.read()
-        await self.abstract_socket.sendall(data)
+        async with self.send_lock:
+            data = self.outgoing.read()
+            if data:
+                await self.abstract_socket.sendall(data)
+
+    def _drain(self, buffer, received: int) -> int:
+        """Decrypts further records, which are already buffered, into the
+        rest of buffer without waiting for the socket."""
+        while received < len(buffer):
+            try:
+                read = self.tls.read(len(buffer) - received,
+                                     buffer[received:])
+            except ssl.SSLWantReadError:
+                # Nothing or an incomplete record left.
+                break
+            except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+                # The end, seen again by the next call.
+                self.peer_closed = True
+                break
+            if not read:
+                self.peer_closed = True
+                break
+            received += read
+        return received
 
     def push_data(self, data):
         """Injects data into the internal read buffer."""
         self.incoming.write(data)
 
     async def close(self) -> AbstractAioSocket:
+        await self.flush()
         await self._communicate(self.tls.unwrap)
         return self.abstract_socket
 
+    async def shutdown(self):
+        """Sends the close_notify, but does not wait for the peer's.
+
+        OpenSSL drops a session from the server side cache if the
+        connection is freed without it, so it could not be resumed by its
+        session ID."""
+        await self.flush()
+        if not self.wrapped:
+            return
+
+        try:
+            self.tls.unwrap()
+        except ssl.SSLError:
+            # SSLWantReadError, the answer is never read.
+            pass
+        await self._send()
+
     async def recv(self, size):
+        buffer = bytearray(size)
+        received = await self.recv_into(buffer)
+        return bytes(buffer[:received])
+
+    async def recv_into(self, buffer) -> int:
+        """Decrypts data directly into the given buffer.
+
+        Every record already received is decrypted, as far as the buffer
+        has room for it."""
         if not self.wrapped:
             await self.handshake()
 
-        # if not await self._recv():
-        #     return b''
-        return await self._communicate(functools.partial(self.tls.read, size))
+        buffer = memoryview(buffer).cast("B")
+        try:
+            received = await self._communicate(
+                functools.partial(self.tls.read, len(buffer), buffer))
+        except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+            return 0
+        received = self._drain(buffer, received)
+
+        if not self.session_stored:
+            self._store_session()
+        return received
+
+    async def wait_readable(self) -> None:
+        """Returns immediately if decrypted or raw data is already buffered,
+        otherwise waits for the underlying socket."""
+        if self.peer_closed or self.tls.pending() or self.incoming.pending:
+            return
+
+        await self.abstract_socket.wait_readable()
+
+    def interrupt_wait(self) -> None:
+        self.abstract_socket.interrupt_wait()
 
     async def sendall(self, data):
         if not self.wrapped:
             await self.handshake()
 
-        # print(data)
+        if self.write_error is not None:
+            raise self.write_error
+
+        if not self.write_window:
+            await self._write(data)
+            return
+
+        # Small writes are collected until a record is full or the window
+        # passed.
+        self.write_buffer += data
+        if len(self.write_buffer) >= MAXIMUM_RECORD_SIZE:
+            await self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(
+                self.write_window, self._flush_later)
+
+    async def flush(self):
+        """Sends the writes held back by the write window."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.write_buffer:
+            data = bytes(self.write_buffer)
+            self.write_buffer.clear()
+            await self._write(data)
+
+    def _flush_later(self):
+        self.flush_handle = None
+
+        async def flush():
+            try:
+                await self.flush()
+            except Exception as e:
+                self.write_error = e
+
+        self.loop.create_task(flush())
+
+    async def _write(self, data):
         await self._communicate(functools.partial(self.tls.write, data))
         await self._send()
 
@@ -0,0 +1,457 @@
+"""
+Capture pipeline: tunnels put encoded PCAP records into a bounded queue, a
+single task per event loop writes them to disk in large batches. The writes
+happen on a thread of their own, so a slow disk does not block the loop.
+
+In the "single" mode, all connections go into one file. It is rotated by
+size and/or age, each file starts with its own PCAP header. In the
+"connection" mode, each connection gets a file of its own (see
+ConnectionCaptureWriter).
+
+Files can be compressed with gzip or zstd, on the capture thread. Wireshark
+opens both directly (zstd since version 4.2).
+
+If the disk cannot keep up, the overflow policy decides whether tunnels wait
+("block"), or new ("drop-newest") or queued ("drop-oldest") records are
+dropped. Records are only dropped as a whole, so the files stay readable, the
+TCP streams in them just have gaps.
+"""
+import asyncio
+import gzip
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Deque, List, Optional, Set, Tuple
+
+from .defaults import PCAP_PATH
+from .pcap import RecordSink, file_header
+from .util.lru import LruCache
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd compressed captures.
+    zstandard = None
+
+OVERFLOW_POLICIES = ("block", "drop-newest", "drop-oldest")
+
+# File name extension and default level of each compression.
+COMPRESSIONS = {
+    "none": ("", None),
+    "gzip": (".gz", 6),
+    "zstd": (".zst", 3),
+}
+
+DEFAULT_QUEUE_SIZE = 16 * 2 ** 20
+DEFAULT_FLUSH_INTERVAL = 0.2
+# The writer does not wait for the flush interval once this much is queued.
+BATCH_SIZE = 2 ** 20
+
+DEFAULT_MAX_OPEN_FILES = 256
+DEFAULT_IDLE_FLUSH = 1.0
+# A connection's records are written once this much is buffered.
+FLOW_BUFFER_SIZE = 2 ** 16
+
+
+class CaptureWriter(RecordSink):
+    queue_size: int
+    overflow: str
+    rotate_size: int
+    rotate_interval: float
+    flush_interval: float
+    compression: str
+    # Appended to the file names, e.g. ".gz".
+    extension: str
+
+    # Bytes currently queued.
+    queued: int
+    written_bytes: int
+    dropped_bytes: int
+    dropped_records: int
+    files: int
+
+    def __init__(self, directory: str = PCAP_PATH, suffix: str = "",
+                 queue_size: int = DEFAULT_QUEUE_SIZE,
+                 overflow: str = "block", rotate_size: int = 0,
+                 rotate_interval: float = 0,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 compression: str = "none",
+                 compression_level: Optional[int] = None):
+        """
+        :param suffix: Appended to the file names, e.g. to keep workers apart.
+        :param rotate_size: Start a new file once one has this many
+                            (uncompressed) bytes, 0 never does.
+        :param rotate_interval: Start a new file once one is this many
+                                seconds old, 0 never does.
+        :param compression_level: None uses the compression's default.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown capture overflow policy {overflow!r}, "
+                             f"possible are {', '.join(OVERFLOW_POLICIES)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown capture compression {compression!r}, "
+                             f"possible are {', '.join(COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("The zstd capture compression needs the "
+                             "zstandard package.")
+
+        self.directory = Path(directory)
+        self.suffix = suffix
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.extension, default_level = COMPRESSIONS[compression]
+        self.compression_level = compression_level \
+            if compression_level is not None else default_level
+
+        # Records with the flow they belong to (None in the single mode).
+        self.queue: Deque[Tuple[Optional["CaptureFlow"], bytes]] = deque()
+        self.queued = 0
+        self.written_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_records = 0
+        self.files = 0
+
+        # Created lazily, they need a running event loop on Python < 3.10.
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._writable: Optional[asyncio.Event] = None
+
+        self.executor = ThreadPoolExecutor(1, "tmmp-capture")
+        self.file: Optional[BinaryIO] = None
+        self.filename: Optional[Path] = None
+        self.file_size = 0
+        self.file_opened = 0.0
+
+    @property
+    def batch_ready(self) -> asyncio.Event:
+        if self._batch_ready is None:
+            self._batch_ready = asyncio.Event()
+        return self._batch_ready
+
+    @property
+    def writable(self) -> asyncio.Event:
+        if self._writable is None:
+            self._writable = asyncio.Event()
+            self._writable.set()
+        return self._writable
+
+    def write(self, records: bytes):
+        self.enqueue(None, records)
+
+    def enqueue(self, flow: Optional["CaptureFlow"], records: bytes):
+        size = len(records)
+
+        if self.queued + size > self.queue_size:
+            if self.overflow == "drop-newest":
+                self.drop(size)
+                return
+            if self.overflow == "drop-oldest":
+                while self.queue and self.queued + size > self.queue_size:
+                    _, oldest = self.queue.popleft()
+                    self.queued -= len(oldest)
+                    self.drop(len(oldest))
+            else:
+                # Taken anyway, the tunnel waits in drain() before reading
+                # more. So the queue grows by at most a chunk per tunnel.
+                self.writable.clear()
+
+        self.queue.append((flow, records))
+        self.queued += size
+        if self.queued >= BATCH_SIZE:
+            self.batch_ready.set()
+
+    async def drain(self):
+        if self.overflow == "block" and self.queued > self.queue_size:
+            await self.writable.wait()
+
+    def drop(self, size: int):
+        if not self.dropped_records:
+            print(f"Capture queue is full ({self.queue_size} bytes), "
+                  f"dropping records ({self.overflow}).")
+        self.dropped_bytes += size
+        self.dropped_records += 1
+
+    def take_batch(self) -> List[Tuple[Optional["CaptureFlow"], bytes]]:
+        batch = list(self.queue)
+        self.queue.clear()
+        self.queued = 0
+        self.batch_ready.clear()
+        self.writable.set()
+        return batch
+
+    async def run(self):
+        """Writes the queued records until cancelled."""
+        try:
+            while True:
+                if self.queued < BATCH_SIZE:
+                    # Not wait_for(), it may swallow the cancellation if the
+                    # event is set at the same time.
+                    ready = asyncio.ensure_future(self.batch_ready.wait())
+                    try:
+                        await asyncio.wait((ready,),
+                                           timeout=self.flush_interval)
+                    finally:
+                        ready.cancel()
+
+                batch = self.take_batch()
+                try:
+                    await self.write_batch(batch)
+                except OSError as e:
+                    print(f"Could not write capture to {self.filename}: {e}")
+                    self.dropped_bytes += sum(len(r) for _, r in batch)
+                    self.dropped_records += len(batch)
+                    await self.close_file()
+        finally:
+            try:
+                await self.write_batch(self.take_batch())
+            finally:
+                await self.finish()
+
+    async def in_thread(self, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, function, *args)
+
+    async def write_batch(self, batch: List[Tuple[Optional["CaptureFlow"],
+                                                  bytes]]):
+        """Called by run() every flush interval, also with an empty
+        batch."""
+        if self.file is not None and self.should_rotate():
+            await self.close_file()
+
+        if batch:
+            await self.write_to_file(b"".join(records for _, records in batch))
+
+    async def finish(self):
+        """Called once run() is cancelled and the last batch written."""
+        await self.close_file()
+
+    def should_rotate(self) -> bool:
+        if self.rotate_size and self.file_size >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval) and \
+            time.monotonic() - self.file_opened >= self.rotate_interval
+
+    async def write_to_file(self, data: bytes):
+        if self.file is None:
+            await self.open_file()
+
+        await self.in_thread(self.file.write, data)
+        self.file_size += len(data)
+        self.written_bytes += len(data)
+
+    async def open_file(self):
+        name = f"{int(time.time())}{self.suffix}"
+        filename = self.directory.joinpath(f"{name}.pcap{self.extension}")
+        # Rotated by size within the same second.
+        index = 1
+        while filename.exists():
+            filename = self.directory.joinpath(
+                f"{name}-{index}.pcap{self.extension}")
+            index += 1
+
+        file = await self.in_thread(self.open_capture_file, filename, "wb")
+        self.file, self.filename = file, filename
+        self.file_opened = time.monotonic()
+        self.file_size = 0
+        self.files += 1
+
+        await self.write_to_file(file_header())
+
+    def open_capture_file(self, path: Path, mode: str) -> BinaryIO:
+        """Opens a file, compressing what is written to it.
+
+        Appending to a compressed file starts a new gzip member or zstd
+        frame, readers decompress the members of a file as one stream."""
+        if self.compression == "gzip":
+            return gzip.open(path, mode, compresslevel=self.compression_level)
+        if self.compression == "zstd":
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(
+                level=self.compression_level))
+        return open(path, mode)
+
+    async def close_file(self):
+        if self.file is None:
+            return
+
+        file, self.file = self.file, None
+        await self.in_thread(file.close)
+        print(f"Capture: wrote {self.file_size} bytes to {self.filename}, "
+              f"{self.dropped_bytes} bytes dropped so far.")
+
+
+class CaptureFlow(RecordSink):
+    """The records of one connection, written to a file of its own."""
+    path: Path
+    # Records taken from the queue, but not written yet.
+    buffer: List[bytes]
+    buffered: int
+    last_record: float
+    # Whether the file exists (with its header).
+    created: bool
+    closed: bool
+
+    def __init__(self, capture: "ConnectionCaptureWriter", path: Path):
+        self.capture = capture
+        self.path = path
+        self.buffer = []
+        self.buffered = 0
+        self.last_record = 0.0
+        self.created = False
+        self.closed = False
+
+    def write(self, records: bytes):
+        self.capture.enqueue(self, records)
+
+    async def drain(self):
+        await self.capture.drain()
+
+    def close(self):
+        self.closed = True
+        self.capture.pending.add(self)
+
+
+class ConnectionCaptureWriter(CaptureWriter):
+    """
+    Writes each connection to its own file, named by the tunnel (see
+    Tunnel.new_pcap_name), below the capture directory.
+
+    The records of a connection are buffered until there are
+    FLOW_BUFFER_SIZE bytes, the connection was idle for idle_flush seconds or
+    it is closed. At most max_open_files files are kept open, the least
+    recently written one is closed if another one is needed, and reopened to
+    append later.
+    """
+    max_open_files: int
+    idle_flush: float
+    # Bytes in the buffers of the flows.
+    buffered: int
+
+    def __init__(self, directory: str = PCAP_PATH,
+                 max_open_files: int = DEFAULT_MAX_OPEN_FILES,
+                 idle_flush: float = DEFAULT_IDLE_FLUSH, **kwargs):
+        super().__init__(directory, **kwargs)
+        self.max_open_files = max_open_files
+        self.idle_flush = idle_flush
+        self.buffered = 0
+
+        # Flows with buffered records, or closed ones with an open file.
+        self.pending: Set[CaptureFlow] = set()
+        # Only used by the capture thread.
+        self.open_files: LruCache[CaptureFlow, BinaryIO] = \
+            LruCache(max_open_files, lambda _, file: file.close())
+
+    def stream(self, name: Path) -> RecordSink:
+        path = self.directory.joinpath(name)
+        return CaptureFlow(self, path.with_name(path.name + self.extension))
+
+    async def write_batch(self, batch: List[Tuple[Optional["CaptureFlow"],
+                                                  bytes]]):
+        now = time.monotonic()
+        for flow, records in batch:
+            flow.buffer.append(records)
+            flow.buffered += len(records)
+            flow.last_record = now
+            self.buffered += len(records)
+            self.pending.add(flow)
+
+        # The buffers hold at most as much as the queue.
+        flush_all = self.buffered > self.queue_size
+        writes = []
+        for flow in list(self.pending):
+            if flow.closed or flow.buffered >= FLOW_BUFFER_SIZE or \
+                    now - flow.last_record >= self.idle_flush or flush_all:
+                writes.append((flow, b"".join(flow.buffer), flow.closed))
+                self.buffered -= flow.buffered
+                flow.buffer, flow.buffered = [], 0
+                self.pending.discard(flow)
+
+        if writes:
+            await self.in_thread(self.write_flows, writes)
+
+    async def finish(self):
+        for flow in self.pending:
+            flow.closed = True
+        await self.write_batch([])
+        await self.in_thread(self.close_files)
+
+    def write_flows(self, writes: List[Tuple[CaptureFlow, bytes, bool]]):
+        """Runs in the capture thread."""
+        for flow, data, close in writes:
+            try:
+                if data:
+                    file = self.open_flow(flow)
+                    file.write(data)
+                    # Flushing a compressor would make the output larger,
+                    # compressed files are complete once they are closed.
+                    if not self.extension:
+                        file.flush()
+                    self.written_bytes += len(data)
+            except OSError as e:
+                print(f"Could not write capture to {flow.path}: {e}")
+                self.dropped_bytes += len(data)
+                self.dropped_records += 1
+
+            if close and flow in self.open_files:
+                file = self.open_files.get(flow)
+                del self.open_files[flow]
+                file.close()
+
+    def open_flow(self, flow: CaptureFlow) -> BinaryIO:
+        file = self.open_files.get(flow)
+        if file is not None:
+            return file
+
+        if flow.created:
+            file = self.open_capture_file(flow.path, "ab")
+        else:
+            flow.path.parent.mkdir(parents=True, exist_ok=True)
+            file = self.open_capture_file(flow.path, "wb")
+            file.write(file_header())
+            flow.created = True
+            self.files += 1
+
+        self.open_files[flow] = file
+        return file
+
+    def close_files(self):
+        for file in self.open_files.entries.values():
+            file.close()
+        self.open_files.clear()
+
+
+CAPTURE_MODES = {
+    "single": CaptureWriter,
+    "connection": ConnectionCaptureWriter,
+}
+
+
+def from_config(config: dict, suffix: str = "") -> CaptureWriter:
+    mode = config.get("mode", "single")
+    if mode not in CAPTURE_MODES:
+        raise ValueError(f"Unknown capture mode {mode!r}, possible are "
+                         f"{', '.join(CAPTURE_MODES)}")
+
+    options = {}
+    if mode == "connection":
+        options = {
+            "max_open_files": config.get("max_open_files",
+                                         DEFAULT_MAX_OPEN_FILES),
+            "idle_flush": config.get("idle_flush", DEFAULT_IDLE_FLUSH),
+        }
+
+    return CAPTURE_MODES[mode](
+        directory=config.get("directory", PCAP_PATH),
+        suffix=suffix,
+        queue_size=config.get("queue_size", DEFAULT_QUEUE_SIZE),
+        overflow=config.get("overflow", "block"),
+        rotate_size=config.get("rotate_size", 0),
+        rotate_interval=config.get("rotate_interval", 0),
+        flush_interval=config.get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+        compression=config.get("compression", "none"),
+        compression_level=config.get("compression_level"),
+        **options
+    )
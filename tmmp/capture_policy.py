@@ -0,0 +1,116 @@
+"""
+Capture policy: decides once per connection, when its tunnel is created,
+whether it is captured and how many bytes of it.
+
+The rules ([[capture.rules]] in the config) are tried in order, the first one
+matching the connection decides. Connections no rule matches are decided by
+the "sample" and "max_bytes" options of the [capture] section.
+"""
+import fnmatch
+import ipaddress
+import random
+import re
+
+from typing import (Any, Iterable, List, Mapping, Optional, Pattern,
+                    Sequence, Union)
+
+RULE_OPTIONS = ("hosts", "clients", "ports", "sample", "max_bytes")
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class CaptureRule:
+    """
+    Matches connections by the host the client asked the proxy for (e.g.
+    "*.googlevideo.com"), the client's subnet and the destination port.
+    Options which are not set match every connection.
+
+    Matching connections are captured with a probability of sample, and at
+    most max_bytes bytes of their data (both directions, 0 is unlimited).
+    """
+    hosts: Optional[Pattern]
+    clients: List[Network]
+    ports: Sequence[int]
+    sample: float
+    max_bytes: int
+
+    def __init__(self, hosts: Iterable[str] = (), clients: Iterable[str] = (),
+                 ports: Iterable[int] = (), sample: float = 1.0,
+                 max_bytes: int = 0):
+        if not 0 <= sample <= 1:
+            raise ValueError(f"Capture sample rate {sample} is not between 0 "
+                             f"and 1.")
+
+        patterns = [fnmatch.translate(host.lower().rstrip("."))
+                    for host in hosts]
+        self.hosts = re.compile("|".join(patterns)) if patterns else None
+        self.clients = [ipaddress.ip_network(client, strict=False)
+                        for client in clients]
+        self.ports = frozenset(ports)
+        self.sample = sample
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "CaptureRule":
+        unknown = set(config) - set(RULE_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown capture rule options "
+                             f"{', '.join(sorted(unknown))}, possible are "
+                             f"{', '.join(RULE_OPTIONS)}")
+        return cls(**config)
+
+    def matches(self, host: str, port: int,
+                client: Union[ipaddress.IPv4Address, ipaddress.IPv6Address]) \
+            -> bool:
+        if self.ports and port not in self.ports:
+            return False
+        if self.clients and not any(client in network
+                                    for network in self.clients):
+            return False
+        return self.hosts is None or self.hosts.match(host) is not None
+
+    def sampled(self) -> bool:
+        return self.sample >= 1 or random.random() < self.sample
+
+
+class CapturePolicy:
+    rules: Sequence[CaptureRule]
+    # Used for connections no rule matches.
+    default: CaptureRule
+
+    def __init__(self, rules: Sequence[CaptureRule] = (),
+                 default: Optional[CaptureRule] = None):
+        self.rules = rules
+        self.default = default if default is not None else CaptureRule()
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "CapturePolicy":
+        """Creates the policy from the [capture] section."""
+        return cls(
+            [CaptureRule.from_config(rule)
+             for rule in config.get("rules", ())],
+            CaptureRule(sample=config.get("sample", 1.0),
+                        max_bytes=config.get("max_bytes", 0))
+        )
+
+    def evaluate(self, host: Union[str, bytes], port: int, client: str) \
+            -> Optional[CaptureRule]:
+        """Returns the rule the connection is captured by, None if it is not
+        captured.
+
+        :param host: The hostname or address the client asked the proxy for.
+        :param client: The client's address.
+        """
+        if isinstance(host, bytes):
+            host = host.decode("ascii", "replace")
+        host = host.lower().rstrip(".")
+
+        address = ipaddress.ip_address(client.split("%")[0])
+        # The listener is an IPv6 socket, IPv4 clients arrive mapped.
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        for rule in self.rules:
+            if rule.matches(host, port, address):
+                return rule if rule.sampled() else None
+        return self.default if self.default.sampled() else None
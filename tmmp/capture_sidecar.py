@@ -0,0 +1,426 @@
+"""
+Capture in a sidecar process: tunnels only copy their data into a shared
+memory ring buffer, the sidecar encodes, compresses and writes it (with the
+CaptureWriters from capture.py), so none of that competes with the proxy's
+event loop.
+
+Each record in the ring has a flow id, a kind (a new flow with its addresses
+and file name, data of either side, or the end of the flow), a timestamp and
+the payload. There is exactly one writer (the proxy process) and one reader
+(its sidecar). Both only advance their own position, after the records
+before it are complete. This relies on aligned 8 byte stores not being torn
+or reordered, so the sidecar is only available on x86.
+
+If the ring is full, the overflow policy decides: "drop-newest" drops the
+data (counted in dropped_bytes), "block" makes tunnels wait in drain() until
+the sidecar caught up. New and ended flows are never dropped, they wait in a
+backlog. If the sidecar dies, nothing is captured anymore and the tunnels
+keep working.
+
+usage (started by the proxy): python -m tmmp.capture_sidecar
+    shared_memory_name capture_config_json file_suffix parent_pid
+"""
+import asyncio
+import json
+import os
+import platform
+import signal
+import struct
+import subprocess
+import sys
+import time
+
+from collections import deque
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Mapping, Optional, Tuple
+
+from .capture import from_config as capture_from_config
+from .pcap import PacketWriter, Payload
+
+DEFAULT_RING_SIZE = 64 * 2 ** 20
+# Larger payloads are split, so "block" never waits for a record which does
+# not fit into the ring (it holds at least two of them) and each part fits
+# into a packet.
+MAXIMUM_RECORD = 2 ** 15
+MINIMUM_RING_SIZE = 2 * MAXIMUM_RECORD
+# Processors which make plain stores visible to others in order.
+X86_MACHINES = ("x86_64", "amd64", "i386", "i686", "x86")
+# How long the sidecar sleeps if the ring is empty, and tunnels sleep in
+# drain() if it is full.
+POLL_INTERVAL = 0.005
+# The sidecar frees the ring and lets its writer run after this many bytes.
+CONSUME_BATCH = 2 ** 20
+
+# The positions are in separate cache lines, each one is written by one side.
+WRITE_POSITION = 0
+READ_POSITION = 64
+# Set to 1 by the sidecar once it attached, so the name can be unlinked.
+ATTACHED = 128
+# Set to 1 by the proxy if it stops capturing.
+CLOSING = 136
+CAPACITY = 144
+DATA = 192
+
+POSITION = struct.Struct("=Q")
+# Payload length, flow id, kind, timestamp
+RECORD = struct.Struct("=IIB3xd")
+ALIGNMENT = 8
+MAXIMUM_PAYLOAD = MAXIMUM_RECORD - RECORD.size
+
+OPEN, SERVER, CLIENT, CLOSE, WRAP = range(5)
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) & -ALIGNMENT
+
+
+class SharedRing:
+    """The ring buffer, with the methods of the writing and reading side."""
+    capacity: int
+
+    def __init__(self, memory: SharedMemory):
+        self.memory = memory
+        self.buffer = memory.buf
+        self.capacity = POSITION.unpack_from(self.buffer, CAPACITY)[0]
+
+        # Only the own side's position is kept, the other one is read.
+        self.write_position = POSITION.unpack_from(self.buffer,
+                                                   WRITE_POSITION)[0]
+        self.read_position = POSITION.unpack_from(self.buffer,
+                                                  READ_POSITION)[0]
+
+    @classmethod
+    def create(cls, capacity: int = DEFAULT_RING_SIZE) -> "SharedRing":
+        capacity = _aligned(capacity)
+        memory = SharedMemory(create=True, size=DATA + capacity)
+        memory.buf[:DATA] = bytes(DATA)
+        POSITION.pack_into(memory.buf, CAPACITY, capacity)
+        return cls(memory)
+
+    @classmethod
+    def attach(cls, name: str) -> "SharedRing":
+        # The creator unlinks it, the resource tracker of this process must
+        # not do so (again) when it exits.
+        if sys.version_info >= (3, 13):
+            return cls(SharedMemory(name, track=False))
+
+        memory = SharedMemory(name)
+        if os.name == "posix":
+            # Registered with the leading slash of the POSIX name.
+            resource_tracker.unregister("/" + memory.name, "shared_memory")
+        return cls(memory)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def get_flag(self, offset: int) -> bool:
+        return bool(POSITION.unpack_from(self.buffer, offset)[0])
+
+    def set_flag(self, offset: int):
+        POSITION.pack_into(self.buffer, offset, 1)
+
+    def put(self, kind: int, flow: int, timestamp: float,
+            payload: Payload) -> bool:
+        """Copies a record into the ring, False if it is full."""
+        size = _aligned(RECORD.size + len(payload))
+        position = self.write_position
+        offset = position % self.capacity
+
+        # Records are never split, the rest of the ring is skipped.
+        skip = self.capacity - offset if offset + size > self.capacity else 0
+        read = POSITION.unpack_from(self.buffer, READ_POSITION)[0]
+        if position + skip + size - read > self.capacity:
+            return False
+
+        if skip:
+            if skip >= RECORD.size:
+                RECORD.pack_into(self.buffer, DATA + offset, 0, 0, WRAP, 0.0)
+            position += skip
+            offset = 0
+
+        start = DATA + offset
+        RECORD.pack_into(self.buffer, start, len(payload), flow, kind,
+                         timestamp)
+        start += RECORD.size
+        self.buffer[start:start + len(payload)] = payload
+
+        self.write_position = position + size
+        POSITION.pack_into(self.buffer, WRITE_POSITION, self.write_position)
+        return True
+
+    def consume(self, handler: Callable[[int, int, float, memoryview], None],
+                limit: int = CONSUME_BATCH) -> int:
+        """Calls handler(kind, flow, timestamp, payload) for the records in
+        the ring, until limit bytes were read. The payload is only valid
+        during the call.
+
+        :return: How many bytes were read.
+        """
+        position = start = self.read_position
+        written = POSITION.unpack_from(self.buffer, WRITE_POSITION)[0]
+
+        while position < written and position - start < limit:
+            offset = position % self.capacity
+            if self.capacity - offset < RECORD.size:
+                position += self.capacity - offset
+                continue
+
+            length, flow, kind, timestamp = RECORD.unpack_from(
+                self.buffer, DATA + offset)
+            if kind == WRAP:
+                position += self.capacity - offset
+                continue
+
+            payload_start = DATA + offset + RECORD.size
+            with self.buffer[payload_start:payload_start + length] as payload:
+                handler(kind, flow, timestamp, payload)
+            position += _aligned(RECORD.size + length)
+
+        self.read_position = position
+        POSITION.pack_into(self.buffer, READ_POSITION, position)
+        return position - start
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+
+class SidecarFlow:
+    """What a tunnel captures with, same interface as a PacketWriter."""
+    # Bytes which may still be captured, None without limit.
+    remaining: Optional[int]
+
+    def __init__(self, capture: "SidecarCapture", flow: int,
+                 max_bytes: int = 0):
+        self.capture = capture
+        self.flow = flow
+        self.remaining = max_bytes or None
+
+    def server(self, data: Payload):
+        data = self.limit(data)
+        if data:
+            self.capture.put(SERVER, self.flow, data)
+
+    def client(self, data: Payload):
+        data = self.limit(data)
+        if data:
+            self.capture.put(CLIENT, self.flow, data)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.remaining == 0
+
+    def limit(self, data: Payload) -> Payload:
+        if self.remaining is None:
+            return data
+
+        data = data[:self.remaining]
+        self.remaining -= len(data)
+        return data
+
+    async def drain(self):
+        await self.capture.drain()
+
+    def close(self):
+        self.capture.put(CLOSE, self.flow, b"", control=True)
+
+
+class SidecarCapture:
+    """
+    The proxy side: creates the ring and starts the sidecar. Passed to the
+    tunnels instead of a CaptureWriter.
+    """
+    overflow: str
+    dropped_bytes: int
+    dropped_records: int
+    # Whether the sidecar exited, nothing is captured anymore then.
+    failed: bool
+
+    def __init__(self, config: Mapping[str, Any], suffix: str = ""):
+        """
+        :param config: The [capture] section, the sidecar creates its
+                       CaptureWriter from it.
+        """
+        if platform.machine().lower() not in X86_MACHINES:
+            raise ValueError(f"The capture sidecar is only available on x86, "
+                             f"not on {platform.machine()}.")
+
+        self.overflow = config.get("overflow", "block")
+        if self.overflow not in ("block", "drop-newest"):
+            raise ValueError(f"The capture overflow policy {self.overflow!r} "
+                             f"is not possible with a sidecar, possible are "
+                             f"block, drop-newest")
+
+        ring_size = config.get("ring_size", DEFAULT_RING_SIZE)
+        if ring_size < MINIMUM_RING_SIZE:
+            raise ValueError(f"The capture ring_size must be at least "
+                             f"{MINIMUM_RING_SIZE} bytes.")
+
+        self.ring = SharedRing.create(ring_size)
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", __name__, self.ring.name,
+             json.dumps(dict(config)), suffix, str(os.getpid())],
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)}
+        )
+
+        # Records which did not fit into the ring yet, in order.
+        self.backlog: Deque[Tuple[int, int, float, bytes]] = deque()
+        self.next_flow = 0
+        self.dropped_bytes = 0
+        self.dropped_records = 0
+        self.failed = False
+
+    def flow_writer(self, client: Tuple[str, int], server: Tuple[str, int],
+                    name: Path, max_bytes: int = 0) -> SidecarFlow:
+        flow = self.next_flow
+        self.next_flow = (flow + 1) & 0xff_ff_ff_ff
+
+        self.put(OPEN, flow, "\n".join((
+            client[0], str(client[1]), server[0], str(server[1]), str(name)
+        )).encode(), control=True)
+        return SidecarFlow(self, flow, max_bytes)
+
+    def put(self, kind: int, flow: int, payload: Payload,
+            control: bool = False):
+        """
+        :param control: Whether the record must not be dropped.
+        """
+        if self.failed:
+            return
+
+        if len(payload) > MAXIMUM_PAYLOAD:
+            view = memoryview(payload)
+            for start in range(0, len(view), MAXIMUM_PAYLOAD):
+                self.put(kind, flow, view[start:start + MAXIMUM_PAYLOAD],
+                         control)
+            return
+
+        timestamp = time.time()
+        if not self.backlog and self.ring.put(kind, flow, timestamp, payload):
+            return
+
+        if control or self.overflow == "block":
+            self.backlog.append((kind, flow, timestamp, bytes(payload)))
+        else:
+            self.drop(len(payload))
+
+    def drop(self, size: int):
+        if not self.dropped_records:
+            print(f"Capture ring is full ({self.ring.capacity} bytes), "
+                  f"dropping data.")
+        self.dropped_bytes += size
+        self.dropped_records += 1
+
+    def flush_backlog(self) -> bool:
+        """Moves records from the backlog into the ring, False if some did
+        not fit."""
+        while self.backlog:
+            if not self.ring.put(*self.backlog[0]):
+                return False
+            self.backlog.popleft()
+        return True
+
+    async def drain(self):
+        if self.overflow != "block":
+            return
+
+        while not self.flush_backlog() and not self.failed:
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def wait_attached(self):
+        """Waits until the sidecar started reading the ring."""
+        while not self.ring.get_flag(ATTACHED) and not self.failed \
+                and self.process.poll() is None:
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def run(self):
+        """Unlinks the ring once the sidecar attached and watches it, until
+        cancelled."""
+        try:
+            unlinked = False
+            while True:
+                if self.process.poll() is not None:
+                    print(f"Capture sidecar exited with "
+                          f"{self.process.returncode}, capture stopped.")
+                    self.failed = True
+                    self.backlog.clear()
+                    break
+
+                # Nobody else needs the name, so it is never leaked.
+                if not unlinked and self.ring.get_flag(ATTACHED):
+                    self.ring.memory.unlink()
+                    unlinked = True
+
+                # Control records and blocked data of idle tunnels.
+                self.flush_backlog()
+                await asyncio.sleep(POLL_INTERVAL if self.backlog else 0.1)
+        finally:
+            if not self.failed:
+                self.ring.set_flag(CLOSING)
+            if not unlinked:
+                self.ring.memory.unlink()
+
+
+async def serve_ring(ring: SharedRing, config: Mapping[str, Any],
+                     suffix: str, parent: int):
+    """The sidecar: encodes and writes the records until the proxy exits."""
+    # The ring provides the backpressure, so the writer does not drop.
+    writer = capture_from_config({**config, "overflow": "block"}, suffix)
+    writer_task = asyncio.get_event_loop().create_task(writer.run())
+    flows: Dict[int, PacketWriter] = {}
+
+    def handle(kind: int, flow: int, timestamp: float, payload: memoryview):
+        if kind == OPEN:
+            client_ip, client_port, server_ip, server_port, name = \
+                bytes(payload).decode().split("\n")
+            flows[flow] = writer.flow_writer(
+                (client_ip, int(client_port)), (server_ip, int(server_port)),
+                Path(name))
+        elif kind == CLOSE:
+            packet_writer = flows.pop(flow, None)
+            if packet_writer is not None:
+                packet_writer.close()
+        elif flow in flows:
+            if kind == SERVER:
+                flows[flow].server(payload, timestamp)
+            else:
+                flows[flow].client(payload, timestamp)
+
+    ring.set_flag(ATTACHED)
+    while True:
+        if ring.consume(handle):
+            await writer.drain()
+            # Lets the writer take the batch.
+            await asyncio.sleep(0)
+            continue
+
+        if ring.get_flag(CLOSING) or os.getppid() != parent:
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+
+    for packet_writer in flows.values():
+        packet_writer.close()
+    writer_task.cancel()
+    await asyncio.gather(writer_task, return_exceptions=True)
+    ring.close()
+
+
+def main(argv=sys.argv):
+    # The proxy decides when to stop, Ctrl+C reaches its whole group.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    name, config, suffix, parent = argv[1:5]
+    try:
+        ring = SharedRing.attach(name)
+    except FileNotFoundError:
+        # The proxy stopped capturing before the sidecar was started.
+        print("Capture ring is gone, the capture sidecar exits.")
+        return
+    asyncio.run(serve_ring(ring, json.loads(config), suffix, int(parent)))
+
+
+if __name__ == "__main__":
+    main()
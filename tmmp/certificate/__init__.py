@@ -1,2 +1,3 @@
 from .abc import CertificateManager
 from .selfsigned import SelfSignedCertificateManager
+from .store import CertificateStore
@@ -1,48 +1,190 @@
+import asyncio
+import os
+
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Dict, Union
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar, Union
 from uuid import uuid4
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import \
+    Encoding, PrivateFormat, NoEncryption, \
+    load_pem_private_key
 
 from cryptography import x509
 from cryptography.x509 import CertificateBuilder
 from cryptography.x509.oid import NameOID
 
+from .store import CertificateStore
+from ..util.publicsuffix import PublicSuffixList
+
+CERTIFICATE_VALIDITY = timedelta(days=365 * 10)
+DEFAULT_SIGNING_THREADS = 4
+# Types of the leaf keys, in the order of preference.
+KEY_TYPES = ("ecdsa", "rsa")
+
+T = TypeVar("T")
+
 
 class CertificateManager(ABC):
     """
     A CertificateManager creates x509 certificates for the TLS proxy.
 
     It contains an internal keystore for the on-the-fly generation of certificates.
+
+    The synchronous methods may block for a long time while a certificate is
+    signed. The event loop should use their async variants instead, which run
+    them in a thread pool.
     """
     keys: Dict[str, Any] = {}
+    # Start of validity of all certificates issued with the current keys.
+    not_before: Optional[datetime] = None
+    signing_threads: int = DEFAULT_SIGNING_THREADS
+    # Certificates of all these key types are served, the TLS library picks
+    # the one the client supports.
+    key_types: Tuple[str, ...] = KEY_TYPES
+    # If set, certificates are issued for "*.parent" instead of the hostname.
+    wildcards: Optional[PublicSuffixList] = None
+    # Where issued certificates are kept across restarts, if anywhere.
+    store: Optional[CertificateStore] = None
+
+    _executor: Optional[Executor] = None
+    _executor_pid: Optional[int] = None
+    # (method, hostname, key type) -> result of the call running in the
+    # thread pool
+    _pending: Dict[Tuple[str, str, str], asyncio.Future]
 
     @abstractmethod
-    def get_certificate(self, hostname: str) -> str:
+    def get_certificate(self, hostname: str, key_type: str = "rsa") -> str:
         """Creates an x509 certificate in PEM format for the given hostname and
-        returns a filename to the certificate."""
+        key type and returns a filename to the certificate."""
 
     @abstractmethod
     def get_certificate_password(self) \
             -> Union[str, bytes, None]:
         """Returns the password for a previously generated certificate."""
 
+    def certificate_name(self, hostname: str) -> str:
+        """Returns the name the certificate for hostname is issued for.
+
+        That is the hostname itself, or a wildcard name covering it if
+        wildcard certificates are enabled."""
+        if self.wildcards is None:
+            return hostname
+        return self.wildcards.wildcard_name(hostname)
+
+    def get_certificate_pem(self, hostname: str, key_type: str = "rsa") \
+            -> Tuple[bytes, bytes]:
+        """Returns the PEM certificate (chain) and the unencrypted PEM key
+        for the given hostname and key type.
+
+        Managers which keep their certificates in memory should override
+        this, by default the file of get_certificate() is read."""
+        with open(self.get_certificate(hostname, key_type), "rb") as file:
+            pem = file.read()
+
+        password = self.get_certificate_password()
+        if isinstance(password, str):
+            password = password.encode()
+        key = load_pem_private_key(pem, password, default_backend())
+
+        return pem, key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8,
+                                      NoEncryption())
+
+    async def get_certificate_async(self, hostname: str,
+                                    key_type: str = "rsa") -> str:
+        """Async variant of get_certificate()."""
+        return await self._single_flight(self.get_certificate, hostname,
+                                         key_type)
+
+    async def get_certificate_pem_async(self, hostname: str,
+                                        key_type: str = "rsa") \
+            -> Tuple[bytes, bytes]:
+        """Async variant of get_certificate_pem()."""
+        return await self._single_flight(self.get_certificate_pem, hostname,
+                                         key_type)
+
+    async def _single_flight(self, function: Callable[[str, str], T],
+                             hostname: str, key_type: str) -> T:
+        """Runs function(hostname, key_type) in the thread pool.
+
+        Concurrent calls for the same hostname wait for the first one instead
+        of issuing the certificate again."""
+        executor = self.get_executor()
+        key = (function.__name__, self.certificate_name(hostname), key_type)
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_event_loop().run_in_executor(
+                executor, function, hostname, key_type)
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+
+        # A cancelled waiter must not cancel the others.
+        return await asyncio.shield(future)
+
+    def get_executor(self) -> Executor:
+        """Returns the thread pool of this process."""
+        if self._executor_pid != os.getpid():
+            # Threads do not survive fork(), every worker needs its own pool.
+            self._executor = ThreadPoolExecutor(
+                self.signing_threads, thread_name_prefix="certificates")
+            self._executor_pid = os.getpid()
+            self._pending = {}
+        return self._executor
+
+    def mark_used(self, hostname: str):
+        """Called whenever the certificates of hostname are served, also if
+        the caller cached them. Managers with a bounded store keep the most
+        used ones with it; it must not block."""
+
     def keygen(self):
         """Prepares the keys."""
+        self.not_before = datetime.utcnow().replace(microsecond=0)
         self.keys["rsa"] = rsa.generate_private_key(
             public_exponent=65537,
             key_size=3072,
             backend=default_backend()
         )
         self.keys["ecdsa"] = ec.generate_private_key(
-            ec.SECP256R1, default_backend()
+            ec.SECP256R1(), default_backend()
         )
 
+    def current_not_before(self, renew_before: timedelta) -> datetime:
+        """Start of validity for new certificates.
+
+        That is the creation of the keys, unless certificates starting then
+        would expire within renew_before. Then it is today, which all
+        processes still agree on."""
+        now = datetime.utcnow()
+        if self.not_before + CERTIFICATE_VALIDITY - renew_before > now:
+            return self.not_before
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def load_keys(self, store: Optional[CertificateStore] = None):
+        """Prepares the keys, reusing the ones in the store if there are."""
+        if store is None:
+            self.keygen()
+            return
+
+        def generate():
+            self.keygen()
+            return dict(self.keys), self.not_before
+
+        self.keys, self.not_before = store.get_keys(generate)
+        # Workers may be forked next.
+        store.close()
+
     @staticmethod
-    def prepare_certificate(hostname):
+    def prepare_certificate(hostname, serial: Optional[int] = None,
+                            not_before: Optional[datetime] = None):
+        if serial is None:
+            serial = uuid4().int
+        if not_before is None:
+            not_before = datetime.utcnow()
+
         # Mostly from:
         # https://www.programcreek.com/python/example/102792/
         #   cryptography.x509.CertificateBuilder
@@ -73,9 +215,9 @@ class CertificateManager(ABC):
             ),
             critical=True
         ).serial_number(
-            uuid4().int
+            serial
         ).not_valid_before(
-            datetime.utcnow()
+            not_before
         ).not_valid_after(
-            datetime.utcnow() + timedelta(days=365 * 10)
+            not_before + CERTIFICATE_VALIDITY
         )
@@ -1,18 +1,20 @@
+from datetime import timedelta
 from secrets import token_bytes
 from tempfile import NamedTemporaryFile
-from typing import MutableMapping, Union
+from typing import Dict, Tuple, Union
 
-from .abc import CertificateManager
+from .abc import CertificateManager, DEFAULT_SIGNING_THREADS, KEY_TYPES
+from .store import CertificateStore, DEFAULT_STORE_SIZE, \
+    DEFAULT_RENEW_BEFORE
 from ..configuration import Configurable
 from ..defaults import CERTIFICATE_ISSUER
+from ..util.publicsuffix import PublicSuffixList
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric.rsa import \
-    RSAPrivateKeyWithSerialization
 from cryptography.hazmat.primitives.serialization import \
-    Encoding, PrivateFormat, BestAvailableEncryption
+    Encoding, PrivateFormat, BestAvailableEncryption, NoEncryption
 
 
 CERTIFICATE_PASSWORD = token_bytes(32)
@@ -26,46 +28,120 @@ class SelfSignedCertificateManager(CertificateManager, Configurable):
     def __init__(self, configuration, providers):
         super().__init__(configuration, providers)
 
-        self.keygen()
-        self.issuer = configuration.get(
-            "providers", {}).get("selfsigned_cn", CERTIFICATE_ISSUER)
-        self.certificates = {}
-
-    def get_certificate(self, hostname: str) -> str:
-        key: RSAPrivateKeyWithSerialization = self.keys["rsa"]
-
-        if self.certificates.get(hostname) is None:
-            cert_builder = CertificateManager.prepare_certificate(
-                hostname
-            ).add_extension(
-                extension=x509.SubjectKeyIdentifier.from_public_key(
-                    key.public_key()),
-                critical=False
-            ).issuer_name(x509.Name([
-                x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, self.issuer)
-            ])).public_key(
-                key.public_key()
-            )
-            cert: x509.Certificate = cert_builder.sign(key, hashes.SHA256(),
-                                                       backend=default_backend()
-                                                       )
-
-            with NamedTemporaryFile("wb", delete=False) as file:
-                file.write(cert.public_bytes(Encoding.PEM))
-
-                file.write(key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8,
-                                             BestAvailableEncryption(
-                                                 CERTIFICATE_PASSWORD
-                                             )))
+        providers_config = configuration.get("providers", {})
 
-                filename = file.name
-
-            self.certificates[hostname] = filename
-
-            return filename
+        self.store = None
+        if providers_config.get("certificate_store"):
+            self.store = CertificateStore(
+                providers_config["certificate_store"],
+                providers_config.get("certificate_store_size",
+                                     DEFAULT_STORE_SIZE)
+            )
 
-        else:
-            return self.certificates[hostname]
+        self.load_keys(self.store)
+        self.issuer = providers_config.get("selfsigned_cn", CERTIFICATE_ISSUER)
+        self.signing_threads = providers_config.get(
+            "signing_threads", DEFAULT_SIGNING_THREADS)
+        self.key_types = tuple(providers_config.get("key_types", KEY_TYPES))
+        if not self.key_types or not set(self.key_types) <= set(KEY_TYPES):
+            raise ValueError(f"key_types must be a subset of "
+                             f"{', '.join(KEY_TYPES)}.")
+
+        if providers_config.get("wildcard_certificates", False):
+            self.wildcards = PublicSuffixList.from_file(
+                providers_config.get("public_suffix_list"))
+
+        # (certificate name, key type) -> PEM certificate
+        self.certificates: Dict[Tuple[str, str], bytes] = {}
+        # (certificate name, key type) -> file written by get_certificate()
+        self.files: Dict[Tuple[str, str], str] = {}
+
+    def get_certificate(self, hostname: str, key_type: str = "rsa") -> str:
+        name = self.certificate_name(hostname)
+        if self.files.get((name, key_type)) is None:
+            self.files[name, key_type] = self.write_certificate(
+                self.get_certificate_bytes(hostname, key_type), key_type)
+        return self.files[name, key_type]
+
+    def get_certificate_pem(self, hostname: str, key_type: str = "rsa") \
+            -> Tuple[bytes, bytes]:
+        return self.get_certificate_bytes(hostname, key_type), \
+            self.keys[key_type].private_bytes(
+                Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+
+    def get_certificate_bytes(self, hostname: str,
+                              key_type: str = "rsa") -> bytes:
+        """Returns the PEM certificate for hostname from memory, the store
+        or by issuing a new one."""
+        name = self.certificate_name(hostname)
+        if self.certificates.get((name, key_type)) is None:
+            certificate = None
+            if self.store is not None:
+                certificate = self.store.get_certificate(name, key_type)
+
+            if certificate is None:
+                cert = self.issue_certificate(name, key_type)
+                certificate = cert.public_bytes(Encoding.PEM)
+                if self.store is not None:
+                    certificate = self.store.put_certificate(
+                        name, key_type, certificate, cert.not_valid_after)
+
+            self.certificates[name, key_type] = certificate
+
+        return self.certificates[name, key_type]
+
+    def mark_used(self, hostname: str):
+        if self.store is None:
+            return
+
+        name = self.certificate_name(hostname)
+        for key_type in self.key_types:
+            self.store.touch(name, key_type)
+        if self.store.flush_due():
+            self.get_executor().submit(self.store.flush_touches)
+
+    def issue_certificate(self, hostname: str,
+                          key_type: str = "rsa") -> x509.Certificate:
+        key = self.keys[key_type]
+        not_before = self.current_not_before(timedelta(
+            seconds=self.store.renew_before if self.store is not None
+            else DEFAULT_RENEW_BEFORE
+        ))
+
+        cert_builder = CertificateManager.prepare_certificate(
+            hostname,
+            # ECDSA signatures are randomized, so every certificate issued
+            # differs and needs a serial of its own. With a store, all
+            # workers serve the one stored first.
+            x509.random_serial_number(),
+            not_before
+        ).add_extension(
+            extension=x509.SubjectKeyIdentifier.from_public_key(
+                key.public_key()),
+            critical=False
+        ).issuer_name(x509.Name([
+            x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, self.issuer)
+        ])).public_key(
+            key.public_key()
+        )
+        return cert_builder.sign(key, hashes.SHA256(),
+                                 backend=default_backend())
+
+    def write_certificate(self, certificate: bytes,
+                          key_type: str = "rsa") -> str:
+        """Writes the PEM certificate and the key to a file, returns its
+        name."""
+        key = self.keys[key_type]
+
+        with NamedTemporaryFile("wb", delete=False) as file:
+            file.write(certificate)
+
+            file.write(key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8,
+                                         BestAvailableEncryption(
+                                             CERTIFICATE_PASSWORD
+                                         )))
+
+            return file.name
 
     def get_certificate_password(self) -> \
             Union[str, bytes, None]:
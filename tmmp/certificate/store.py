@@ -0,0 +1,256 @@
+"""
+Persistent store for the issuing keys and the generated leaf certificates.
+
+The store is a SQLite database, so several processes (workers or restarted
+proxies) can share it. Writes happen in immediate transactions, which
+SQLite serializes with a file lock.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import \
+    Encoding, PrivateFormat, NoEncryption, load_pem_private_key
+
+DEFAULT_STORE_SIZE = 10000
+# Certificates expiring earlier than this are issued again.
+DEFAULT_RENEW_BEFORE = 24 * 60 * 60
+# Seconds uses of certificates are collected before they are written.
+TOUCH_INTERVAL = 60
+
+# Incremented on incompatible changes of the certificates table.
+SCHEMA_VERSION = 2
+SCHEMA = ("""\
+CREATE TABLE IF NOT EXISTS keys (
+    name TEXT PRIMARY KEY,
+    pem BLOB NOT NULL,
+    created REAL NOT NULL
+)""", """\
+CREATE TABLE IF NOT EXISTS certificates (
+    hostname TEXT NOT NULL,
+    key_type TEXT NOT NULL,
+    pem BLOB NOT NULL,
+    not_after REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (hostname, key_type)
+)""", """\
+CREATE INDEX IF NOT EXISTS certificates_last_used
+    ON certificates (last_used)
+""")
+
+
+class CertificateStore:
+    """
+    Keeps the keys of a CertificateManager and the certificates issued with
+    them.
+
+    At most size certificates are kept, the least recently used ones are
+    evicted first. Uses are recorded in memory by touch() and written
+    together by flush_touches(), so serving a certificate never waits for
+    the write lock.
+    """
+    path: str
+    size: int
+    renew_before: float
+
+    def __init__(self, path: str, size: int = DEFAULT_STORE_SIZE,
+                 renew_before: float = DEFAULT_RENEW_BEFORE):
+        self.path = path
+        self.size = size
+        self.renew_before = renew_before
+
+        # Every thread has its own connection.
+        self._local = threading.local()
+
+        # (hostname, key type) -> last use, not written yet
+        self._touched: Dict[Tuple[str, str], float] = {}
+        self._touched_lock = threading.Lock()
+        self._last_flush = time.time()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # SQLite connections must not be used across fork().
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _connect(self) -> sqlite3.Connection:
+        # The store contains private keys.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        os.close(fd)
+
+        connection = sqlite3.connect(self.path, timeout=30,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+
+        with _Transaction(connection):
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                # The certificates can be issued again, so older tables are
+                # simply dropped.
+                connection.execute("DROP TABLE IF EXISTS certificates")
+                connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            for statement in SCHEMA:
+                connection.execute(statement)
+        return connection
+
+    def close(self):
+        """Closes the connection of this thread, it is opened again when
+        needed.
+
+        Should be called before forking, an open SQLite connection must not
+        be inherited by a child process."""
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.connection.close()
+        self._local.connection = None
+        self._local.pid = None
+
+    def get_keys(self, generate) -> Tuple[Dict[str, Any], datetime]:
+        """Returns the stored keys and their creation time.
+
+        If there are none, generate() is called and has to return new ones.
+        If another process stored its keys meanwhile, those are returned."""
+        stored = self._load_keys()
+        if stored is not None:
+            return stored
+
+        keys, created = generate()
+        with self._transaction() as connection:
+            if connection.execute("SELECT 1 FROM keys").fetchone():
+                return self._load_keys()
+
+            # Certificates issued with previous keys can't be used anymore.
+            connection.execute("DELETE FROM certificates")
+            connection.executemany(
+                "INSERT INTO keys (name, pem, created) VALUES (?, ?, ?)",
+                [(name, key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8,
+                                          NoEncryption()),
+                  _timestamp(created))
+                 for name, key in keys.items()]
+            )
+        return keys, created
+
+    def _load_keys(self) -> Optional[Tuple[Dict[str, Any], datetime]]:
+        rows = self.connection.execute(
+            "SELECT name, pem, created FROM keys").fetchall()
+        if not rows:
+            return None
+
+        keys = {
+            name: load_pem_private_key(pem, None, default_backend())
+            for name, pem, _ in rows
+        }
+        return keys, datetime.utcfromtimestamp(rows[0][2])
+
+    def get_certificate(self, hostname: str,
+                        key_type: str) -> Optional[bytes]:
+        """Returns the PEM certificate for hostname and key type, unless it
+        is missing or about to expire."""
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT pem FROM certificates "
+            "WHERE hostname = ? AND key_type = ? AND not_after > ?",
+            (hostname, key_type, now + self.renew_before)
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.touch(hostname, key_type)
+        return row[0]
+
+    def touch(self, hostname: str, key_type: str):
+        """Records a use of the certificate, it is written with the next
+        flush_touches() or put_certificate()."""
+        with self._touched_lock:
+            self._touched[hostname, key_type] = time.time()
+
+    def flush_due(self) -> bool:
+        """Whether uses were recorded and TOUCH_INTERVAL passed since the
+        last flush. Only returns True once per interval."""
+        with self._touched_lock:
+            now = time.time()
+            if not self._touched or now - self._last_flush < TOUCH_INTERVAL:
+                return False
+            self._last_flush = now
+            return True
+
+    def flush_touches(self):
+        """Writes the recorded uses."""
+        with self._transaction() as connection:
+            self._write_touches(connection)
+
+    def _write_touches(self, connection: sqlite3.Connection):
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+        connection.executemany(
+            "UPDATE certificates SET last_used = max(last_used, ?) "
+            "WHERE hostname = ? AND key_type = ?",
+            [(used, hostname, key_type)
+             for (hostname, key_type), used in touched.items()]
+        )
+
+    def put_certificate(self, hostname: str, key_type: str, pem: bytes,
+                        not_after: datetime) -> bytes:
+        """Stores a certificate and evicts the least recently used ones if
+        the store is full.
+
+        If another process stored a certificate for hostname and key type
+        meanwhile, that one is kept and returned, so all processes serve the
+        same certificate. Otherwise pem is returned."""
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT pem FROM certificates "
+                "WHERE hostname = ? AND key_type = ? AND not_after > ?",
+                (hostname, key_type, now + self.renew_before)
+            ).fetchone()
+            if row is not None:
+                self.touch(hostname, key_type)
+                self._write_touches(connection)
+                return row[0]
+
+            # The eviction below needs the recent uses.
+            self._write_touches(connection)
+            connection.execute(
+                "INSERT OR REPLACE INTO certificates "
+                "(hostname, key_type, pem, not_after, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (hostname, key_type, pem, _timestamp(not_after), now)
+            )
+            connection.execute(
+                "DELETE FROM certificates WHERE rowid IN ("
+                "SELECT rowid FROM certificates "
+                "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.size,)
+            )
+        return pem
+
+    def _transaction(self) -> "_Transaction":
+        return _Transaction(self.connection)
+
+
+def _timestamp(utc: datetime) -> float:
+    """Converts a naive UTC datetime (as used by cryptography)."""
+    return utc.replace(tzinfo=timezone.utc).timestamp()
+
+
+class _Transaction:
+    """Immediate transaction, which takes the write lock at its start."""
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
@@ -0,0 +1,173 @@
+"""
+Connects to the servers clients ask the proxy for, shared by all proxy
+protocols of an event loop.
+
+Like Happy Eyeballs (RFC 8305), the addresses of a host are tried
+alternating between IPv6 and IPv4, each attempt starting attempt_delay
+seconds after the previous one or right after it failed, while the earlier
+attempts keep running. The first connected socket wins, so a dead route or
+unreachable address only costs attempt_delay instead of the kernel's TCP
+timeout, and connect_timeout bounds the whole connection setup.
+"""
+import asyncio
+import socket
+
+from typing import Any, List, Mapping, Optional, Set, Union
+from weakref import WeakKeyDictionary
+
+from .resolver import Addresses, Resolver, get_resolver
+
+# RFC 8305 recommends 250 ms.
+DEFAULT_ATTEMPT_DELAY = 0.25
+DEFAULT_CONNECT_TIMEOUT = 10.0
+
+
+def interleave(addresses: Addresses) -> Addresses:
+    """Orders the addresses alternating between the families, starting with
+    the family of the first one."""
+    if not addresses:
+        return addresses
+
+    first = [a for a in addresses if a[0] == addresses[0][0]]
+    other = [a for a in addresses if a[0] != addresses[0][0]]
+    ordered = []
+    for index in range(max(len(first), len(other))):
+        ordered += first[index:index + 1] + other[index:index + 1]
+    return ordered
+
+
+class Connector:
+    attempt_delay: float
+    connect_timeout: float
+    # Connections set up, and those which needed more than one attempt.
+    connections: int
+    fallbacks: int
+
+    def __init__(self, resolver: Resolver,
+                 attempt_delay: float = DEFAULT_ATTEMPT_DELAY,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 loop: asyncio.AbstractEventLoop = None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.resolver = resolver
+        self.attempt_delay = attempt_delay
+        self.connect_timeout = connect_timeout
+
+        self.connections = 0
+        self.fallbacks = 0
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any], resolver: Resolver,
+                    loop: asyncio.AbstractEventLoop = None) -> "Connector":
+        """Creates the connector from the [upstream] section."""
+        return cls(resolver,
+                   config.get("attempt_delay", DEFAULT_ATTEMPT_DELAY),
+                   config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                   loop)
+
+    async def connect(self, host: Union[str, bytes], port: int) \
+            -> socket.socket:
+        """Returns a non-blocking socket connected to the host.
+
+        Raises socket.gaierror if the host can not be resolved, TimeoutError
+        if no address could be connected to in time, otherwise the OSError
+        of the failed attempt(s)."""
+        deadline = self.loop.time() + self.connect_timeout
+        try:
+            # The lookup is shared and shielded, others may still use it.
+            addresses = interleave(await asyncio.wait_for(
+                self.resolver.resolve(host), self.connect_timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Resolving {host!r} timed out.") from None
+
+        remaining = iter(addresses)
+        attempts: Set[asyncio.Task] = set()
+        errors: List[OSError] = []
+        winner: Optional[socket.socket] = None
+        started = 0
+        try:
+            while winner is None:
+                address = next(remaining, None)
+                if address is not None:
+                    attempts.add(self.loop.create_task(
+                        self.attempt(*address, port)))
+                    started += 1
+                elif not attempts:
+                    break
+
+                # Waits for the delay, or until an attempt finished.
+                while attempts:
+                    timeout = deadline - self.loop.time()
+                    if timeout <= 0:
+                        raise TimeoutError(f"Connecting to {host!r} port "
+                                           f"{port} timed out.")
+                    if address is not None:
+                        timeout = min(timeout, self.attempt_delay)
+
+                    done, attempts = await asyncio.wait(
+                        attempts, timeout=timeout,
+                        return_when=asyncio.FIRST_COMPLETED)
+                    for attempt in done:
+                        if attempt.exception() is not None:
+                            errors.append(attempt.exception())
+                        elif winner is None:
+                            winner = attempt.result()
+                        else:
+                            attempt.result().close()
+
+                    # The next address is tried right after a failure.
+                    if done or address is not None:
+                        break
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            if attempts:
+                # The attempts close their sockets when cancelled.
+                await asyncio.wait(attempts)
+                for attempt in attempts:
+                    if not attempt.cancelled() and \
+                            attempt.exception() is None:
+                        attempt.result().close()
+
+        if winner is not None:
+            self.connections += 1
+            if started > 1:
+                self.fallbacks += 1
+            return winner
+        if len(errors) == 1 or len({str(e) for e in errors}) == 1:
+            raise errors[0]
+        raise OSError(f"Could not connect to {host!r} port {port}: "
+                      f"{'; '.join(str(e) for e in errors)}")
+
+    async def attempt(self, family: int, address: str, port: int) \
+            -> socket.socket:
+        s = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            s.setblocking(False)
+            await self.loop.sock_connect(s, (address, port))
+        except BaseException:
+            s.close()
+            raise
+        return s
+
+
+_connectors: "WeakKeyDictionary[asyncio.AbstractEventLoop, Connector]" = \
+    WeakKeyDictionary()
+
+
+def get_connector(loop: asyncio.AbstractEventLoop = None,
+                  configuration: Optional[Mapping[str, Any]] = None) \
+        -> Connector:
+    """Returns the connector of the given (or current) event loop, it is
+    created from the [upstream] section of the configuration on first
+    use."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    connector = _connectors.get(loop)
+    if connector is None:
+        connector = _connectors[loop] = Connector.from_config(
+            (configuration or {}).get("upstream", {}),
+            get_resolver(loop, configuration), loop)
+    return connector
@@ -2,23 +2,26 @@
 Module containing the interactive script.
 """
 import asyncio
-import io
+import os
+import signal
 import socket
 import sys
-import time
 
-from typing import List
+from contextlib import suppress
+from typing import List, Optional, Union
 
 from .aiosock import AioSocket
+from .capture import CaptureWriter, from_config as capture_from_config
+from .capture_policy import CapturePolicy
+from .capture_sidecar import SidecarCapture
 from .configuration import Provider
 from .certificate import SelfSignedCertificateManager
 from .parse_config import parse_config
 from .protocols.application import TlsProtocol
 from .protocols.proxy import ProxyProtocol, EMPTY_RESPONSE, SocksProxy
+from .supervisor import Supervisor, send_heartbeats, HEARTBEAT_TIMEOUT
 from .tunnel import Tunnel
 
-from aiofile import AIOFile
-from scapy.all import PcapWriter
 
 USAGE = """\
 usage: tmmp (--help | --example | config_file)
@@ -39,6 +42,10 @@ Configurable options are:
 listen: IPv6(!) address where to listen on. To listen on \
 IPv4, use ::ffff:ipv4 (default "::" = all interfaces dualstack).
 port: Port to listen on (default 1234)
+workers: Count of worker processes, each with an own event loop and \
+listening socket (default 1 = no worker processes).
+heartbeat_timeout: Seconds after which a worker without heartbeat is \
+restarted (default 10).
 
 -- Section "proxy"
 protocol: Which protocol to use (e.g. socks, http, simple; default "socks").
@@ -46,6 +53,8 @@ protocol_class: Alternatively describe python class to use in the form \
 "module.sub:class".
 
 Depending on the protocol (or class) chosen, it may require additional options.
+max_header_size: For "http", how many bytes the request line and headers of \
+a CONNECT request may have (default 16384).
 
 -- Section "application"
 max_depth: How many times protocols in protocols (e.g. TLS in TLS) is allowed \
@@ -53,14 +62,153 @@ max_depth: How many times protocols in protocols (e.g. TLS in TLS) is allowed \
 protocols: List of application protocols by name (default ["tls"]).
 protocols_class: List of application protocols (default not set).
 
+-- Section "dns"
+How the hostnames clients ask for are resolved, shared by all connections \
+of a worker.
+cache_size: How many hostnames are cached (default 4096).
+ttl: Seconds answers are cached at most, answers of the system resolver \
+have no TTL and are always cached this long (default 60).
+negative_ttl: Seconds hostnames which do not exist are cached at most \
+(default 10).
+nameserver: Address (and port) of a name server, e.g. "127.0.0.53" or \
+"[::1]:5353", which is asked directly over UDP instead of using the system \
+resolver in a thread (default not set).
+timeout: Seconds until a query to the name server is repeated, it fails \
+after the second try (default 1).
+stats_interval: Seconds between the lines with the cache hit ratio and the \
+average lookup time; 0 never prints them (default 300).
+
+-- Section "upstream"
+How connections to the servers are set up. Like Happy Eyeballs (RFC 8305), \
+the addresses of a host are tried alternating between IPv6 and IPv4, the \
+first connected one is used.
+attempt_delay: Seconds after which the next address is tried, while the \
+earlier attempts keep running; after a failed attempt it is tried right \
+away (default 0.25).
+connect_timeout: Seconds after which the connection to a server fails, if \
+no address could be connected to (default 10).
+
 -- Section "tls"
 ciphers: Which ciphers to allow on the listening side \
 (default "ALL", this is intentionally insecure).
+context_cache_size: How many listening side TLS contexts (one per hostname) \
+are kept ready for reuse. With keylog_file, each of them holds a file \
+descriptor, so the limit of open files (ulimit -n) has to allow for that \
+many more (default 1024).
+stats_interval: Seconds between the lines with the hits and misses of the \
+TLS caches; 0 never prints them (default 300).
+engine: "sni" uses one listening TLS context, which switches to the \
+certificate of the requested host in its SNI callback; certificates are kept \
+in memory. "files" builds a context per host from a certificate file \
+(default "sni").
+early_client_handshake: Do the handshake with the client at the same time \
+as the one with the server, instead of after it. Saves a round trip to the \
+server, but the client may see its connection closed right after the \
+handshake if the server can not be reached (default false).
+write_coalescing_window: Seconds small writes to TLS connections are held \
+back, so they are sent together in fewer records and syscalls; 0 sends \
+every write immediately (default 0).
+session_tickets: Whether clients get TLS session tickets to resume their \
+sessions with. Without them, TLS 1.2 clients can still resume by session ID \
+(default true).
+ticket_key_lifetime: Seconds after which the session ticket keys are \
+replaced, sessions issued before can not be resumed anymore; 0 never \
+replaces them. With several workers the keys are never replaced, they share \
+the keys of the "sni" engine's listening context. With the "files" engine, \
+the contexts of hostnames which are not prewarmed have other keys in every \
+worker, so a client is only resumed if it reaches the same worker again \
+(default 3600).
+upstream_session_cache_size: How many TLS sessions with servers are kept, \
+so new connections to the same server resume them instead of doing a full \
+handshake; 0 disables it (default 1024).
+upstream_session_ttl: Seconds after which a session is not resumed anymore \
+(default 300).
+prewarm: List of hostnames whose certificates are issued at startup, in the \
+background or, with several workers, once before they are started, e.g. \
+["example.com", "*.cdn.example.com"]; wildcard names need \
+providers.wildcard_certificates (default []).
+keylog_file: File the TLS secrets of both sides of every connection are \
+appended to, in the NSS key log format Wireshark decrypts captures with. \
+Each TLS context keeps the file open, see context_cache_size (default the \
+SSLKEYLOGFILE environment variable, otherwise not set = no key log).
 
 -- Section "providers"
 certificates: Values possible are "selfsigned" or "ca" (default "selfsigned").\
  If "ca" is used, "cacert" must be set.
 selfsigned_cn: To what value the CN of the issue field should be set.
+certificate_store: SQLite file keeping the keys and issued certificates \
+across restarts, shared by all workers (default not set = in memory only).
+certificate_store_size: How many certificates the store keeps at most, the \
+least recently used ones are evicted first (default 10000).
+key_types: Key types of the issued certificates, a certificate of each type \
+is served and the client picks the one it supports. Possible are "ecdsa" \
+(P-256, much faster handshakes) and "rsa" (default ["ecdsa", "rsa"]).
+wildcard_certificates: Issue certificates for "*.parent.domain" instead of \
+each hostname, so one certificate covers all its siblings. Never done below \
+public suffixes like "co.uk" (default false).
+public_suffix_list: Path to a public_suffix_list.dat from \
+https://publicsuffix.org/list/, otherwise only common suffixes are known \
+(default not set).
+signing_threads: How many threads issue certificates, so the event loop is \
+not blocked by signing (default 4).
+
+-- Section "capture"
+enabled: Whether the (decrypted) traffic is written to PCAP files \
+(default true).
+directory: Where the files are written to (default "pcap").
+mode: "single" writes all connections into one file, "connection" writes \
+each connection to its own file in "<directory>/<day>/<hour>/<hash>/" \
+(default "single").
+queue_size: How many bytes of captured packets may wait for the disk \
+(default 16777216).
+overflow: What happens if the queue is full: "block" slows the tunnels \
+down, "drop-newest" and "drop-oldest" drop packets and count them \
+(default "block").
+rotate_size: In the "single" mode, start a new file once the current one \
+has this many bytes, 0 never does (default 0).
+rotate_interval: In the "single" mode, start a new file once the current \
+one is this many seconds old, 0 never does (default 0).
+flush_interval: Seconds after which queued packets are written, even if \
+there are only a few (default 0.2).
+max_open_files: In the "connection" mode, how many files are kept open, \
+others are reopened when needed (default 256).
+idle_flush: In the "connection" mode, a connection's packets are buffered \
+until there are 64 KiB, it is closed or no packet came for this many seconds \
+(default 1).
+compression: "none", "gzip" or "zstd" (needs the zstandard package), done \
+on the capture thread. Wireshark opens compressed files directly \
+(default "none").
+compression_level: Default 6 for gzip and 3 for zstd.
+sidecar: Encode, compress and write the packets in a separate process, \
+the proxy only copies the data into a shared memory ring buffer. If the ring \
+is full, "block" slows the tunnels down and "drop-newest" drops data. \
+Only available on x86 (default false).
+ring_size: Size of the ring buffer in bytes, at least 65536 \
+(default 67108864).
+sample: Share of the connections which are captured, if no rule matches \
+(default 1.0).
+max_bytes: How many bytes of a connection (both directions) are captured \
+at most, if no rule matches, 0 captures everything (default 0).
+
+-- Section "capture.rules" (a list, written as [[capture.rules]])
+Decide per connection whether it is captured, when its tunnel is created. \
+The first matching rule applies, options which are not set match everything.
+hosts: Patterns of the hostname or address the client asked the proxy for, \
+e.g. "*.googlevideo.com".
+clients: Subnets of the client, e.g. "10.0.0.0/8".
+ports: Destination ports.
+sample: Share of the matching connections which are captured, 0 captures \
+none of them (default 1.0).
+max_bytes: How many bytes of a matching connection are captured at most, \
+0 captures everything (default 0).
+
+-- Section "tunnel"
+passthrough: Relay connections which are neither intercepted nor captured \
+inside the kernel (splice on Linux). Whether a connection is intercepted is \
+decided by the first packet of the client, protocols started later (like \
+with STARTTLS) are not intercepted then. Connections left out by the capture \
+rules or sampling, or whose max_bytes were captured, are relayed as well \
+(default true).
 
 In the future, it will be possible to set server side verification and \
 outgoing ciphers.
@@ -70,6 +218,7 @@ EXAMPLE = """\
 [server]
 listen = "::"
 port = 1234
+workers = 1
 
 [proxy]
 protocol = "socks"
@@ -79,11 +228,60 @@ protocol = "socks"
 protocols = [ "tls" ]
 # protocols_class = [ "tmmp.protocols.application:TlsProtocol" ]
 
+[dns]
+cache_size = 4096
+ttl = 60
+negative_ttl = 10
+stats_interval = 300
+# nameserver = "127.0.0.53"
+
+[upstream]
+attempt_delay = 0.25
+connect_timeout = 10
+
 [tls]
 ciphers = "ALL"
+context_cache_size = 1024
+stats_interval = 300
+engine = "sni"
+early_client_handshake = false
+write_coalescing_window = 0
+session_tickets = true
+ticket_key_lifetime = 3600
+upstream_session_cache_size = 1024
+upstream_session_ttl = 300
+prewarm = []
+# keylog_file = "sslkeys.log"
 
 [providers]
 certificates = "selfsigned"
+# certificate_store = "certificates.sqlite"
+key_types = [ "ecdsa", "rsa" ]
+wildcard_certificates = false
+
+[capture]
+enabled = true
+mode = "single"
+queue_size = 16777216
+overflow = "block"
+rotate_size = 0
+rotate_interval = 0
+flush_interval = 0.2
+compression = "none"
+sidecar = false
+sample = 1.0
+max_bytes = 0
+
+[[capture.rules]]
+hosts = [ "*.googlevideo.com", "*.windowsupdate.com" ]
+sample = 0
+
+[[capture.rules]]
+ports = [ 443 ]
+max_bytes = 65536
+
+[tunnel]
+passthrough = true
 """
 
 
@@ -102,66 +300,130 @@ def command_line(argv: List[str] = sys.argv):
     return parse_config(sys.argv[1])
 
 
-async def mainloop(sock, config, providers):
+async def mainloop(sock, config, providers, worker: Optional[int] = None):
     loop = asyncio.get_event_loop()
-    buffer = io.BytesIO()
-    writer = PcapWriter(buffer, sync=True)
 
-    loop.create_task(
-        buffer_to_file(f"pcap/{int(time.time())}.pcap", buffer)
-    )
-
-    while True:
-        connection, _ = await loop.sock_accept(sock)
+    for protocol in providers[Provider.APPLICATION_PROTOCOLS]:
+        loop.create_task(protocol.prepare())
+
+    writer, policy, capture_task = None, None, None
+    capture = config.get("capture", {})
+    if capture.get("enabled", True):
+        # Workers must not append to the same file.
+        suffix = "" if worker is None else f"-{os.getpid()}"
+        if capture.get("sidecar", False):
+            writer = SidecarCapture(capture, suffix)
+        else:
+            writer = capture_from_config(capture, suffix)
+        policy = CapturePolicy.from_config(capture)
+        capture_task = loop.create_task(writer.run())
+
+    try:
+        while True:
+            connection, _ = await loop.sock_accept(sock)
 
-        loop.create_task(
-            do_proxy_stuff(loop, connection, config, providers, writer))
+            loop.create_task(do_proxy_stuff(loop, connection, config,
+                                            providers, writer, policy))
+    finally:
+        if capture_task is not None:
+            # Writes what is still queued and closes the capture files.
+            capture_task.cancel()
+            await asyncio.gather(capture_task, return_exceptions=True)
 
 
 async def do_proxy_stuff(loop, connection, config, providers,
-                         write_to: PcapWriter):
-    proxy: ProxyProtocol = providers[Provider.PROXY_PROTOCOL].new({}, loop)
-
-    _, remote = await proxy.proxy_handshake(connection)
-    if remote == EMPTY_RESPONSE:
+                         write_to: Union[CaptureWriter, SidecarCapture,
+                                         None],
+                         policy: Optional[CapturePolicy]):
+    proxy: ProxyProtocol = providers[Provider.PROXY_PROTOCOL].new(config,
+                                                                  loop)
+
+    try:
+        response = await proxy.proxy_handshake(connection)
+    except OSError:
+        # E.g. the client went away during the handshake.
+        connection.close()
         return
+    except BaseException:
+        connection.close()
+        raise
+    if response is EMPTY_RESPONSE:
+        # The proxy protocol answered the client, nothing to tunnel.
+        connection.close()
+        return
+    (host, port), remote = response
+
+    # Decided once, tunnels which are not captured skip the PacketWriter.
+    rule = None
+    if write_to is not None:
+        rule = policy.evaluate(host, port, connection.getpeername()[0])
 
     tunnel = Tunnel(AioSocket(connection), AioSocket(remote),
                     protocols=providers[Provider.APPLICATION_PROTOCOLS],
-                    loop=loop, write_to=write_to)
+                    loop=loop, write_to=write_to if rule else None,
+                    capture_limit=rule.max_bytes if rule else 0,
+                    passthrough=config.get("tunnel", {}).get(
+                        "passthrough", True),
+                    initial_data=proxy.initial_data)
     tunnel.schedule()
 
 
-async def buffer_to_file(filename, buffer):
-    """Writes the PCAP every .2 seconds to avoid synchronous writes."""
-    file = None
+def create_listener(config, reuse_port: bool = False) -> socket.socket:
+    server = config.get("server", {})
+
+    s = socket.socket(socket.AF_INET6)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((server.get("listen", "::"), server.get("port", 1234)))
+    s.listen(1024)
+    s.setblocking(False)
+    return s
 
-    async with AIOFile(str(filename), 'ab') as pcap:
-        while True:
-            await asyncio.sleep(1)
 
-            b = buffer.getvalue()
-            buffer.truncate(0)
-            buffer.seek(0)
+def serve(config, providers, sock: Optional[socket.socket] = None,
+          worker: Optional[int] = None, heartbeat: Optional[int] = None):
+    """Runs the proxy in this process.
 
-            if not b:
-                print("No data.")
-                continue
+    Without a socket, an own listener is created (with SO_REUSEPORT in
+    worker processes)."""
+    if sock is None:
+        sock = create_listener(config, reuse_port=worker is not None)
 
-            print(f"Has {len(b)} bytes.")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
 
-            await pcap.write(b)
-            # await pcap.fsync()
+    if heartbeat is not None:
+        loop.create_task(send_heartbeats(heartbeat))
+    main_task = loop.create_task(mainloop(sock, config, providers, worker))
+    # Lets mainloop() stop the capture, instead of cutting its files off.
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(signum, main_task.cancel)
+    with suppress(asyncio.CancelledError):
+        loop.run_until_complete(main_task)
 
 
 def main():
     config, providers = command_line()
+    server = config.get("server", {})
+    workers = server.get("workers", 1)
 
-    s = socket.socket(socket.AF_INET6)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(('::', 1234))
-    s.listen(1024)
-    s.setblocking(False)
+    if workers <= 1:
+        serve(config, providers, create_listener(config))
+        return
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(mainloop(s, config, providers))
+    for protocol in providers[Provider.APPLICATION_PROTOCOLS]:
+        protocol.prepare_shared()
+
+    # Without SO_REUSEPORT, all workers share one inherited listener.
+    sock = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        sock = create_listener(config)
+
+    Supervisor(
+        lambda worker, heartbeat: serve(config, providers, sock,
+                                        worker, heartbeat),
+        workers,
+        server.get("heartbeat_timeout", HEARTBEAT_TIMEOUT)
+    ).run()
@@ -0,0 +1,130 @@
+"""
+Relays data between two plain sockets without passing it through Python.
+
+On Linux, os.splice() moves the data from one socket into a pipe and from the
+pipe into the other socket, so it never leaves the kernel. Elsewhere the data
+is copied through a pooled buffer.
+"""
+import asyncio
+import os
+
+from socket import socket, SHUT_WR
+
+from .aiosock.buffer import get_buffer_pool
+
+HAS_SPLICE = hasattr(os, "splice")
+# Default capacity of a Linux pipe.
+SPLICE_SIZE = 2 ** 16
+
+
+async def relay(client: socket, server: socket,
+                loop: asyncio.AbstractEventLoop = None) -> None:
+    """Forwards data in both directions until both sides are closed.
+
+    The end of one direction is passed on as a half-close (shutdown of the
+    peer's write side), the other direction keeps going. If a direction
+    fails, the other one is stopped as well.
+
+    The sockets must be non-blocking and are not closed by this function."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    forward = _splice if HAS_SPLICE else _copy
+    tasks = [
+        loop.create_task(forward(client, server, loop)),
+        loop.create_task(forward(server, client, loop)),
+    ]
+
+    try:
+        done, _ = await asyncio.wait(tasks,
+                                     return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Makes sure no reader or writer is left registered.
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for task in done:
+        task.result()
+
+
+def _wait(loop: asyncio.AbstractEventLoop, fd: int,
+          writable: bool = False) -> asyncio.Future:
+    """Returns a future which is done once fd is readable (or writable)."""
+    if writable:
+        add, remove = loop.add_writer, loop.remove_writer
+    else:
+        add, remove = loop.add_reader, loop.remove_reader
+
+    future = loop.create_future()
+
+    def ready():
+        remove(fd)
+        if not future.done():
+            future.set_result(None)
+
+    def cancelled(_):
+        if future.cancelled():
+            remove(fd)
+
+    add(fd, ready)
+    future.add_done_callback(cancelled)
+    return future
+
+
+def _half_close(destination: socket):
+    """Tells the peer nothing more will be sent."""
+    try:
+        destination.shutdown(SHUT_WR)
+    except OSError:
+        # Already reset by the peer.
+        pass
+
+
+async def _splice(source: socket, destination: socket,
+                  loop: asyncio.AbstractEventLoop):
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    read_end, write_end = os.pipe2(os.O_NONBLOCK)
+
+    try:
+        while True:
+            try:
+                pending = os.splice(source.fileno(), write_end, SPLICE_SIZE,
+                                    flags=flags)
+            except BlockingIOError:
+                await _wait(loop, source.fileno())
+                continue
+
+            if not pending:  # EOF
+                _half_close(destination)
+                return
+
+            # Drain the pipe completely, so the next splice into it can't block.
+            while pending:
+                try:
+                    pending -= os.splice(read_end, destination.fileno(),
+                                         pending, flags=flags)
+                except BlockingIOError:
+                    await _wait(loop, destination.fileno(), writable=True)
+    finally:
+        os.close(read_end)
+        os.close(write_end)
+
+
+async def _copy(source: socket, destination: socket,
+                loop: asyncio.AbstractEventLoop):
+    pool = get_buffer_pool(loop)
+
+    while True:
+        await _wait(loop, source.fileno())
+
+        buffer = pool.acquire()
+        try:
+            received = await loop.sock_recv_into(source, buffer)
+            if not received:  # EOF
+                _half_close(destination)
+                return
+
+            await loop.sock_sendall(destination, memoryview(buffer)[:received])
+        finally:
+            pool.release(buffer)
@@ -3,145 +3,262 @@ Helper to write captured data to a pcap as a TCP stream.
 
 The TCP sequence numbers will not be the real ones and are randomly chosen
 for each stream.
+
+Packets are encoded directly: the Ethernet, IPv6 and TCP headers of each
+direction are prepared once, only the sequence numbers, lengths and the
+checksum are filled in per packet.
 """
+import socket
+import struct
+import sys
+import time
 
-from io import BytesIO
+from abc import ABC, abstractmethod
+from pathlib import Path
 from random import randint
-from typing import Iterable, Tuple
+from typing import BinaryIO, Iterable, Optional, Tuple, Union
 
-from scapy.all import PcapWriter
-from scapy.layers.l2 import Ether
-from scapy.layers.inet6 import IPv6, TCP
+Payload = Union[bytes, memoryview]
 
+# The addresses are not known, the same ones are used for all packets.
+SOURCE_MAC = b"\x00" * 6
+DESTINATION_MAC = b"\xff" * 6
+ETHERTYPE_IPV6 = 0x86dd
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
 
-class PacketWriter:
-    client_ip_base: IPv6
-    server_ip_base: IPv6
+TCP_WINDOW = 8192
+TCP_HEADER_LENGTH = 20
+HOP_LIMIT = 64
+
+SYN = 0x02
+ACK = 0x10
+
+# Native byte order like libpcap, readers detect it by the magic number.
+FILE_HEADER = struct.Struct("=IHHiIII")
+RECORD_HEADER = struct.Struct("=IIII")
+# Ethernet header and first word of the IPv6 header | IPv6 payload length |
+# rest of the IPv6 header and TCP ports | seq | ack | data offset | flags |
+# window | checksum | urgent pointer
+PACKET_HEADER = struct.Struct("!18sH38sIIBBHHH")
+DATA_OFFSET = (TCP_HEADER_LENGTH // 4) << 4
+
+
+def file_header() -> bytes:
+    return FILE_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, SNAPLEN, LINKTYPE_ETHERNET)
+
+
+class RecordSink(ABC):
+    """Where PacketWriters put their encoded records."""
+    @abstractmethod
+    def write(self, records: bytes):
+        """Takes one or more complete records, without a file header."""
+
+    async def drain(self):
+        """Waits until the sink accepts more records (backpressure)."""
+        pass
+
+    def stream(self, name: Path) -> "RecordSink":
+        """Returns the sink for the connection with the given file name.
+        Sinks writing all connections to the same place return
+        themselves."""
+        return self
+
+    def close(self):
+        """Called once the connection of a stream() sink ended."""
+        pass
+
+    def flow_writer(self, client: Tuple[str, int], server: Tuple[str, int],
+                    name: Path, max_bytes: int = 0) -> "PacketWriter":
+        """Returns what a tunnel captures its data with."""
+        return PacketWriter(client, server, self.stream(name), max_bytes)
+
+
+class PcapStream(RecordSink):
+    """
+    Writes PCAP records to a binary file (e.g. a BytesIO).
+
+    The file header is written before the first record.
+    """
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.header_written = False
+
+    def write(self, records: bytes):
+        if not self.header_written:
+            self.file.write(file_header())
+            self.header_written = True
+        self.file.write(records)
+
+
+class _Direction:
+    """Header template of the packets sent by one side of the stream."""
+    def __init__(self, source: Tuple[str, int], destination: Tuple[str, int]):
+        addresses = socket.inet_pton(socket.AF_INET6, source[0]) + \
+            socket.inet_pton(socket.AF_INET6, destination[0])
+        ports = struct.pack("!HH", source[1], destination[1])
+
+        self.ethernet_ip = DESTINATION_MAC + SOURCE_MAC + \
+            struct.pack("!HI", ETHERTYPE_IPV6, 6 << 28)
+        self.ip_tcp = struct.pack("!BB", socket.IPPROTO_TCP, HOP_LIMIT) + \
+            addresses + ports
+
+        # 2^16 = 1 (mod 2^16 - 1), so the ones' complement sum of 16 bit
+        # words can be taken from their concatenation modulo 2^16 - 1.
+        self.checksum_base = (
+            int.from_bytes(addresses + ports, "big")
+            + socket.IPPROTO_TCP + TCP_WINDOW
+        )
 
+    def packet(self, seq: int, ack: int, flags: int,
+               data: Payload = b"") -> bytes:
+        length = TCP_HEADER_LENGTH + len(data)
+
+        # Pseudo header (addresses, length, next header) and TCP header.
+        total = self.checksum_base + length + seq + ack + \
+            (DATA_OFFSET << 8 | flags)
+        if data:
+            payload = int.from_bytes(data, "big")
+            if len(data) % 2:
+                payload <<= 8
+            total += payload
+        total %= 0xffff
+        checksum = 0xffff - total if total else 0
+
+        return PACKET_HEADER.pack(
+            self.ethernet_ip, length, self.ip_tcp, seq, ack, DATA_OFFSET,
+            flags, TCP_WINDOW, checksum, 0
+        )
+
+
+class PacketWriter:
     client_seq: int
     server_seq: int
 
-    client_port: int
-    server_port: int
-
-    out: PcapWriter
+    out: RecordSink
 
     tcp_handshake: bool
+    # Bytes which may still be captured, None without limit.
+    remaining: Optional[int]
 
     def __init__(self,
                  client: Tuple[str, int],
                  server: Tuple[str, int],
-                 out_writer: PcapWriter):
-
-        self.client_ip_base = IPv6()
-        self.client_ip_base.src = client[0]
-        self.client_ip_base.dst = server[0]
+                 out_writer: RecordSink,
+                 max_bytes: int = 0):
+        """
+        :param max_bytes: Stop capturing after this much data of both
+                          directions, 0 captures everything.
+        """
 
-        self.server_ip_base = IPv6()
-        self.server_ip_base.src = server[0]
-        self.server_ip_base.dst = client[0]
+        self.from_client = _Direction(client, server)
+        self.from_server = _Direction(server, client)
 
         self.out = out_writer
 
-        self.client_port = client[1]
-        self.server_port = server[1]
-
         self.client_seq = randint(1, 2 ** 32 - 1)
         self.server_seq = randint(1, 2 ** 32 - 1)
 
         self.tcp_handshake = False
+        self.remaining = max_bytes or None
 
-    def write_handshake(self):
+    def write_handshake(self, timestamp: Optional[float] = None):
         self.tcp_handshake = True
 
         self.write_packets((
-            self.client_ip_base / TCP(
-                sport=self.client_port,
-                dport=self.server_port,
-                seq=self.client_seq-1,
-                flags="S"
-            ),
-            self.server_ip_base / TCP(
-                sport=self.server_port,
-                dport=self.client_port,
-                seq=self.server_seq-1,
-                ack=self.client_seq,
-                flags="SA"
-            ),
-            self.client_ip_base / TCP(
-                sport=self.client_port,
-                dport=self.server_port,
-                seq=self.client_seq,
-                ack=self.server_seq,
-                flags="A"
-            )
-        ))
+            (self.from_client.packet((self.client_seq - 1) & 0xff_ff_ff_ff,
+                                     0, SYN), b""),
+            (self.from_server.packet((self.server_seq - 1) & 0xff_ff_ff_ff,
+                                     self.client_seq, SYN | ACK), b""),
+            (self.from_client.packet(self.client_seq, self.server_seq, ACK),
+             b""),
+        ), timestamp)
+
+    def server(self, data: Payload, timestamp: Optional[float] = None):
+        """:param timestamp: When the data was seen, default now."""
+        data = self.limit(data)
+        if not data:
+            return
 
-    def server(self, data: bytes):
         if not self.tcp_handshake:
-            self.write_handshake()
+            self.write_handshake(timestamp)
 
         seq = self.server_seq
         self.server_seq = (seq + len(data)) & 0xff_ff_ff_ff
 
         self.write_packets((
-            self.server_ip_base / TCP(
-                 sport=self.server_port,
-                 dport=self.client_port,
-                 seq=seq,
-                 ack=self.client_seq,
-                 flags="A") / data,
-            self.client_ip_base / TCP (
-                sport=self.client_port,
-                dport=self.server_port,
-                seq=self.client_seq,
-                ack=self.server_seq,
-                flags="A"
-            )
-        ))
+            (self.from_server.packet(seq, self.client_seq, ACK, data), data),
+            (self.from_client.packet(self.client_seq, self.server_seq, ACK),
+             b""),
+        ), timestamp)
+
+    def client(self, data: Payload, timestamp: Optional[float] = None):
+        """:param timestamp: When the data was seen, default now."""
+        data = self.limit(data)
+        if not data:
+            return
 
-    def client(self, data: bytes):
         if not self.tcp_handshake:
-            self.write_handshake()
+            self.write_handshake(timestamp)
 
         seq = self.client_seq
         self.client_seq = (seq + len(data)) & 0xff_ff_ff_ff
 
         self.write_packets((
-            self.client_ip_base / TCP(
-                sport=self.client_port,
-                dport=self.server_port,
-                seq=seq,
-                ack=self.server_seq,
-                flags="A") / data,
-            self.server_ip_base / TCP(
-                sport=self.server_port,
-                dport=self.client_port,
-                seq=self.server_seq,
-                ack=self.client_seq,
-                flags="A"
-            )
-        ))
+            (self.from_client.packet(seq, self.server_seq, ACK, data), data),
+            (self.from_server.packet(self.server_seq, self.client_seq, ACK),
+             b""),
+        ), timestamp)
 
-    def write_packet(self, packet: IPv6):
-        self.write_packets((packet,))
+    @property
+    def exhausted(self) -> bool:
+        """Whether max_bytes were captured."""
+        return self.remaining == 0
 
-    def write_packets(self, packets: Iterable[IPv6]):
-        self.out.write(map(lambda p: Ether() / p, packets))
+    def limit(self, data: Payload) -> Payload:
+        if self.remaining is None:
+            return data
 
+        data = data[:self.remaining]
+        self.remaining -= len(data)
+        return data
 
-if __name__ == "__main__":
-    p = PacketWriter(("2a0d:5940:1:91::2", 1337),
-                     ("2a00:1450:4005:80b::2003", 80))
-    p.client(
-        b"GET / HTTP/1.0\r\n"
-        b"Connection: close\r\n"
-        b"Host: google.com\r\n"
-        b"\r\n"
-    )
-    p.server(
-        b"HTTP/1.0 302 Found\r\n"
-        b"Location: https://www.google.com/\r\n"
-        b"\r\n"
-    )
+    async def drain(self):
+        await self.out.drain()
+
+    def close(self):
+        self.out.close()
 
+    def write_packets(self, packets: Iterable[Tuple[bytes, Payload]],
+                      timestamp: Optional[float] = None):
+        """Writes (header, payload) pairs as records in one chunk."""
+        now = time.time() if timestamp is None else timestamp
+        seconds = int(now)
+        microseconds = int((now - seconds) * 1000000)
+
+        parts = []
+        for header, payload in packets:
+            length = len(header) + len(payload)
+            parts += (
+                RECORD_HEADER.pack(seconds, microseconds, length, length),
+                header, payload
+            )
+        self.out.write(b"".join(parts))
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1] if len(sys.argv) > 1 else "example.pcap",
+              "wb") as file:
+        p = PacketWriter(("2a0d:5940:1:91::2", 1337),
+                         ("2a00:1450:4005:80b::2003", 80), PcapStream(file))
+        p.client(
+            b"GET / HTTP/1.0\r\n"
+            b"Connection: close\r\n"
+            b"Host: google.com\r\n"
+            b"\r\n"
+        )
+        p.server(
+            b"HTTP/1.0 302 Found\r\n"
+            b"Location: https://www.google.com/\r\n"
+            b"\r\n"
+        )
@@ -22,9 +22,24 @@ class ApplicationProtocol(ABC):
     def is_protocol_packet(packet: bytes) -> bool:
         raise NotImplementedError("This ABC does not implement any methods.")
 
+    @staticmethod
+    def missing_bytes(packet: Union[bytes, memoryview]) -> int:
+        """How many more bytes the packet needs, if it may be the start of
+        a protocol packet which arrived split. 0 by default."""
+        return 0
+
     @abstractmethod
     async def wrap_connection(self, packet: bytes, up: AbstractAioSocket,
                               down: AbstractAioSocket,
                               loop: AbstractEventLoop) -> \
             Tuple[AbstractAioSocket, AbstractAioSocket]:
         raise NotImplementedError("This ABC does not implement any methods.")
+
+    def prepare_shared(self):
+        """Called once before the worker processes are forked (only if there
+        are several), what it prepares is shared by all of them. Does
+        nothing by default."""
+
+    async def prepare(self):
+        """Called once the event loop of the proxy is running, e.g. to start
+        background work. Does nothing by default."""
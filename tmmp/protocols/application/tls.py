@@ -1,34 +1,134 @@
-from asyncio import AbstractEventLoop
-from ssl import SSLContext, PROTOCOL_SSLv23, OP_NO_SSLv3, \
+import os
+
+from asyncio import AbstractEventLoop, ensure_future, gather, \
+    get_event_loop, sleep
+from ssl import SSLContext, SSLObject, PROTOCOL_SSLv23, OP_NO_SSLv3, \
+    OP_NO_TICKET, \
     _create_unverified_context
+try:
+    from ssl import OP_IGNORE_UNEXPECTED_EOF
+except ImportError:  # Python < 3.10
+    OP_IGNORE_UNEXPECTED_EOF = 0
 from struct import unpack
-from typing import Tuple
+from typing import List, Optional, Tuple, Union
 
 from .abc import ApplicationProtocol
 from ...aiosock.abc import AbstractAioSocket
+from ...aiosock.session import SessionCache, DEFAULT_SESSION_CACHE_SIZE, \
+    DEFAULT_SESSION_TTL
 from ...aiosock.tls import AioTlsSocket
 from ...configuration import Configurable, Provider
 from ...certificate.abc import CertificateManager
+from ...util.lru import LruCache
+from ...util.tls.context import load_cert_chain_from_memory
 from ...util.tls.sni import get_sni_from_handshake
 
+DEFAULT_CONTEXT_CACHE_SIZE = 1024
+# "sni": One listening context, which switches to the context of the
+# requested host in its SNI callback. Certificates stay in memory.
+# "files": A context per connection, loaded from the certificate file.
+ENGINES = ("sni", "files")
+# Seconds after which the contexts issuing session tickets are replaced.
+DEFAULT_TICKET_KEY_LIFETIME = 60 * 60
+# Seconds between the lines with the cache statistics.
+DEFAULT_STATS_INTERVAL = 5 * 60
+
 
 class TlsProtocol(ApplicationProtocol, Configurable):
     certificate_manager: CertificateManager
+    # (hostname, ciphers) -> server side context with the certificate loaded
+    contexts: LruCache
+    # Context every client facing connection starts with ("sni" engine).
+    # OpenSSL keeps the session cache and ticket keys in it.
+    shared_context: Optional[SSLContext] = None
+    # Client facing handshakes done and resumed.
+    client_handshakes: int = 0
+    client_resumptions: int = 0
+    # Context of all connections to servers, their sessions can only be
+    # resumed with it.
+    upstream_context: SSLContext
+    # (SNI, address, port) -> session of the last connection to the server
+    upstream_sessions: Optional[SessionCache] = None
 
     def __init__(self, configuration, providers):
         # Only for Pycharm linter
         Configurable.__init__(self, configuration, providers)
 
-        self.ciphers = configuration.get(
-
-            "tls", {}).get("ciphers", "ALL")
+        tls_config = configuration.get("tls", {})
+        self.ciphers = tls_config.get("ciphers", "ALL")
+        self.contexts = LruCache(tls_config.get(
+            "context_cache_size", DEFAULT_CONTEXT_CACHE_SIZE))
+        self.stats_interval = tls_config.get("stats_interval",
+                                             DEFAULT_STATS_INTERVAL)
         self.certificate_manager = \
             providers[Provider.CERTIFICATE_MANAGER]
 
+        # NSS key log of both sides of the connections, e.g. for Wireshark.
+        self.keylog_file = tls_config.get("keylog_file",
+                                          os.environ.get("SSLKEYLOGFILE"))
+
+        self.upstream_context = _create_unverified_context(PROTOCOL_SSLv23)
+        self.log_keys(self.upstream_context)
+        session_cache_size = tls_config.get(
+            "upstream_session_cache_size", DEFAULT_SESSION_CACHE_SIZE)
+        if session_cache_size > 0:
+            self.upstream_sessions = SessionCache(
+                session_cache_size,
+                tls_config.get("upstream_session_ttl", DEFAULT_SESSION_TTL)
+            )
+
+        # Hostnames whose certificates are issued at startup.
+        self.prewarm_hostnames = []
+        for hostname in tls_config.get("prewarm", []):
+            if hostname.startswith("*.") and \
+                    self.certificate_manager.wildcards is None:
+                print(f"Not preparing {hostname}, wildcard names are only "
+                      f"used with providers.wildcard_certificates.")
+            else:
+                self.prewarm_hostnames.append(hostname)
+        # Set once prepare_shared() prepared them for all workers.
+        self.prewarmed = False
+
+        self.engine = tls_config.get("engine", "sni")
+        if self.engine not in ENGINES:
+            raise ValueError(f"Unknown TLS engine {self.engine!r}, "
+                             f"expected one of {', '.join(ENGINES)}.")
+
+        # Seconds small writes are collected before they are sent.
+        self.write_window = tls_config.get("write_coalescing_window", 0.0)
+
+        # Whether the client handshake may finish before the server one.
+        self.early_client_handshake = tls_config.get(
+            "early_client_handshake", False)
+
+        self.session_tickets = tls_config.get("session_tickets", True)
+        self.ticket_key_lifetime = tls_config.get(
+            "ticket_key_lifetime", DEFAULT_TICKET_KEY_LIFETIME)
+        if configuration.get("server", {}).get("workers", 1) > 1:
+            # Every worker would generate different keys, so tickets of one
+            # could not be resumed by the others anymore. The keys of the
+            # shared context, created before the fork, are kept instead.
+            if "ticket_key_lifetime" in tls_config:
+                print("Session ticket keys are not rotated with several "
+                      "workers.")
+            self.ticket_key_lifetime = 0
+
+        if self.engine == "sni":
+            self.shared_context = self.create_shared_context()
+
     @staticmethod
     def get_protocol_name() -> str:
         return "TLS"
 
+    @staticmethod
+    def missing_bytes(packet: Union[bytes, memoryview]) -> int:
+        # The rest of a record which starts like a handshake.
+        if len(packet) < 2 or packet[0] != 0x16 or packet[1] != 3:
+            return 0
+        if len(packet) < 5:
+            return 5 - len(packet)
+        return max(0, 5 + unpack("!H", packet[3:5])[0] - len(packet))
+
     @staticmethod
     def is_protocol_packet(packet: bytes) -> bool:
         if len(packet) < 50:  # TODO: Find better value.
@@ -51,22 +151,245 @@ class TlsProtocol(ApplicationProtocol, Configurable):
         # TODO: What to do, if sni returns 'None'?
         sni = get_sni_from_handshake(packet)
 
+        # The certificate only depends on the SNI, so it is prepared while
+        # the server handshake is running.
+        server = ensure_future(self.wrap_server(down, sni, loop), loop=loop)
+        try:
+            if self.early_client_handshake:
+                new_up = await self.wrap_client(packet, up, sni, loop)
+                new_down = await server
+            else:
+                ctx = await self.prepare_server_context(sni)
+                new_down = await server
+                new_up = await self.wrap_client(packet, up, sni, loop, ctx)
+        finally:
+            server.cancel()
+            # It may have failed without being awaited, e.g. if the client
+            # handshake failed first.
+            if server.done() and not server.cancelled():
+                server.exception()
+        print("Done")
+
+        return new_up, new_down
+
+    async def wrap_server(self, down: AbstractAioSocket, sni: Optional[str],
+                          loop: AbstractEventLoop) -> AioTlsSocket:
         print("Wrapping Server")
-        new_down: AbstractAioSocket = AioTlsSocket(
-            down, _create_unverified_context(PROTOCOL_SSLv23),
-            server_hostname=sni, loop=loop
+        new_down = AioTlsSocket(
+            down, self.upstream_context, server_hostname=sni, loop=loop,
+            session_cache=self.upstream_sessions,
+            session_key=(sni, *down.get_real_socket().getpeername()[:2]),
+            write_window=self.write_window
         )
         await new_down.handshake()
+        return new_down
+
+    async def wrap_client(self, packet: bytes, up: AbstractAioSocket,
+                          sni: Optional[str], loop: AbstractEventLoop,
+                          ctx: Optional[SSLContext] = None) -> AioTlsSocket:
+        """Does the handshake with the client.
+
+        :param ctx: The context prepare_server_context() returned for sni,
+                    it is prepared if not given.
+        """
+        if ctx is None:
+            ctx = await self.prepare_server_context(sni)
+        if sni is not None:
+            self.certificate_manager.mark_used(sni)
+        if self.shared_context is not None:
+            # The SNI callback picks ctx from the cache again.
+            ctx = self.shared_context
 
-        certificate_file = self.certificate_manager.get_certificate(sni)
-        ctx = SSLContext(PROTOCOL_SSLv23)
-        ctx.set_ciphers(self.ciphers)
-        ctx.load_cert_chain(certificate_file, certificate_file,
-                            self.certificate_manager.get_certificate_password())
         print("Wrapping Client")
-        new_up = AioTlsSocket(up, ctx, True, loop=loop)
+        new_up = AioTlsSocket(up, ctx, True, loop=loop,
+                              write_window=self.write_window)
         new_up.push_data(packet)
         await new_up.handshake()
-        print("Done")
 
-        return new_up, new_down
+        self.client_handshakes += 1
+        self.client_resumptions += new_up.tls.session_reused
+        return new_up
+
+    @property
+    def client_resumption_rate(self) -> float:
+        if not self.client_handshakes:
+            return 0.0
+        return self.client_resumptions / self.client_handshakes
+
+    async def prepare(self):
+        """Issues the certificates of the configured hostnames in the
+        background, so their first connections do not wait for it.
+
+        Also starts the rotation of the session ticket keys and the
+        statistics report."""
+        if self.ticket_key_lifetime > 0:
+            get_event_loop().create_task(self.rotate_ticket_keys())
+        if self.stats_interval > 0:
+            get_event_loop().create_task(self.report_statistics())
+        if self.prewarmed:
+            return
+
+        async def prewarm(hostname: str):
+            try:
+                await self.prepare_server_context(hostname)
+            except Exception as e:
+                print(f"Could not prepare certificate for {hostname}: {e!r}")
+
+        if self.prewarm_hostnames:
+            await gather(*map(prewarm, self.prewarm_hostnames))
+            print(f"Prepared certificates of "
+                  f"{len(self.prewarm_hostnames)} hostname(s).")
+
+    def prepare_shared(self):
+        """Issues the certificates of the configured hostnames before the
+        workers are forked, so they all inherit the contexts instead of
+        each issuing them again."""
+        for hostname in self.prewarm_hostnames:
+            try:
+                self.get_server_context(hostname)
+            except Exception as e:
+                print(f"Could not prepare certificate for {hostname}: {e!r}")
+        if self.prewarm_hostnames:
+            print(f"Prepared certificates of "
+                  f"{len(self.prewarm_hostnames)} hostname(s).")
+        self.prewarmed = True
+
+        # The workers must not inherit the connection opened for that.
+        if self.certificate_manager.store is not None:
+            self.certificate_manager.store.close()
+
+    async def prepare_server_context(self, hostname: str) -> SSLContext:
+        """Like get_server_context(), but the certificates are issued
+        without blocking the event loop."""
+        key = self.context_key(hostname)
+        ctx = self.contexts.get(key)
+        if ctx is not None:
+            return ctx
+
+        manager = self.certificate_manager
+        if self.engine == "sni":
+            issue = manager.get_certificate_pem_async
+        else:
+            issue = manager.get_certificate_async
+        certificates = await gather(*(
+            issue(hostname, key_type) for key_type in manager.key_types
+        ))
+
+        ctx = self.contexts[key] = self.create_server_context(certificates)
+        return ctx
+
+    def get_server_context(self, hostname: str) -> SSLContext:
+        """Returns the context for the client facing side of connections to
+        hostname.
+
+        Contexts are cached, so the certificates are only loaded on the first
+        connection to a host. The connection was already counted by
+        prepare_server_context(), so this lookup is not."""
+        key = self.context_key(hostname)
+        ctx = self.contexts.peek(key)
+        if ctx is not None:
+            return ctx
+
+        manager = self.certificate_manager
+        if self.engine == "sni":
+            issue = manager.get_certificate_pem
+        else:
+            issue = manager.get_certificate
+        certificates = [issue(hostname, key_type)
+                        for key_type in manager.key_types]
+
+        ctx = self.contexts[key] = self.create_server_context(certificates)
+        return ctx
+
+    async def rotate_ticket_keys(self):
+        """Replaces the contexts holding the session cache and ticket keys
+        periodically.
+
+        The ssl module can not set ticket keys, but every new context
+        generates random ones. Sessions of the old contexts can not be
+        resumed afterwards, those clients do a full handshake once."""
+        while True:
+            await sleep(self.ticket_key_lifetime)
+
+            if self.shared_context is not None:
+                self.shared_context = self.create_shared_context()
+            else:
+                self.contexts.clear()
+            print("Rotated session ticket keys.")
+
+    def statistics(self) -> List[str]:
+        """Describes the counters of the caches."""
+        lines = [
+            f"context cache {self.contexts.hits} hits, "
+            f"{self.contexts.misses} misses",
+        ]
+        if self.upstream_sessions is not None:
+            lines.append(f"upstream sessions {self.upstream_sessions.resumed} "
+                         f"of {self.upstream_sessions.handshakes} "
+                         f"handshakes resumed")
+        lines.append(f"client sessions {self.client_resumptions} of "
+                     f"{self.client_handshakes} handshakes resumed")
+        return lines
+
+    async def report_statistics(self):
+        """Prints the statistics every stats_interval seconds."""
+        while True:
+            await sleep(self.stats_interval)
+            print(f"TLS: {'; '.join(self.statistics())}")
+
+    def context_key(self, hostname: str) -> Tuple[str, str]:
+        # Hosts sharing a wildcard certificate share the context as well.
+        return self.certificate_manager.certificate_name(hostname), \
+            self.ciphers
+
+    def create_shared_context(self) -> SSLContext:
+        ctx = SSLContext(PROTOCOL_SSLv23)
+        ctx.set_ciphers(self.ciphers)
+        # A client closing without close_notify ends the connection like
+        # with it, instead of losing its session.
+        ctx.options |= OP_IGNORE_UNEXPECTED_EOF
+        if not self.session_tickets:
+            ctx.options |= OP_NO_TICKET
+        ctx.sni_callback = self.select_context
+        self.log_keys(ctx)
+        return ctx
+
+    def create_server_context(
+            self, certificates: List[Union[str, Tuple[bytes, bytes]]]) \
+            -> SSLContext:
+        """Builds a listening context from certificate files ("files"
+        engine) or PEM certificates and keys ("sni" engine).
+
+        The certificates should have different key types (e.g. ECDSA and
+        RSA). OpenSSL serves the first one matching the signature algorithms
+        and ciphers offered by the client."""
+        ctx = SSLContext(PROTOCOL_SSLv23)
+        ctx.set_ciphers(self.ciphers)
+        ctx.options |= OP_IGNORE_UNEXPECTED_EOF
+        if not self.session_tickets:
+            ctx.options |= OP_NO_TICKET
+        for certificate in certificates:
+            if self.engine == "sni":
+                load_cert_chain_from_memory(ctx, *certificate)
+            else:
+                ctx.load_cert_chain(
+                    certificate, certificate,
+                    self.certificate_manager.get_certificate_password())
+        # OpenSSL logs with the context selected in the SNI callback.
+        self.log_keys(ctx)
+        return ctx
+
+    def log_keys(self, ctx: SSLContext):
+        """Makes OpenSSL append the secrets of the context's connections to
+        the key log file, TLS 1.2 master secrets and TLS 1.3 traffic secrets.
+
+        Each line is flushed right away with O_APPEND, so the lines of all
+        workers stay whole. Every context keeps the file open."""
+        if self.keylog_file:
+            ctx.keylog_filename = self.keylog_file
+
+    def select_context(self, ssl_object: SSLObject,
+                       server_name: Optional[str], _: SSLContext):
+        """SNI callback of the shared context."""
+        if server_name is not None:
+            ssl_object.context = self.get_server_context(server_name)
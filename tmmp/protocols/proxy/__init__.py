@@ -1,5 +1,6 @@
 from .abc import ProxyProtocol
 from ._empty import EMPTY_RESPONSE
 from .http_connect import HttpConnectProxy
+from .reader import HandshakeReader
 from .simple import SimpleProxy
 from .socks import SocksProxy
@@ -5,6 +5,10 @@ from typing import Any, Mapping, Tuple
 
 
 class ProxyProtocol(ABC):
+    # What the client sent right behind the proxy handshake, it is the start
+    # of the tunnel's data.
+    initial_data: bytes = b""
+
     @staticmethod
     @abstractmethod
     def new(configuration: Mapping[str, Any], loop: AbstractEventLoop) \
@@ -1,50 +1,168 @@
-from asyncio import AbstractEventLoop
-from socket import socket, IPPROTO_TCP
-from typing import Any, Mapping, Tuple
+import re
+
+from asyncio import (AbstractEventLoop, IncompleteReadError,
+                     LimitOverrunError)
+from socket import socket
+from typing import Any, Dict, Mapping, Tuple
 
 from .abc import ProxyProtocol
 from ._empty import EMPTY_RESPONSE
+from .reader import HandshakeReader
+from ...connector import Connector, get_connector
+
+# Most bytes the request line and headers may have together.
+DEFAULT_MAX_HEADER_SIZE = 2 ** 14
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+LINE_END = re.compile(rb"\r?\n")
+
+
+def parse_head(head: bytes) -> Tuple[bytes, bytes, bytes, Dict[bytes, bytes]]:
+    """Splits the request line and headers (without the empty line) into
+    method, target, version and the headers by lower case name.
+
+    Raises ValueError if they are malformed."""
+    request_line, *lines = LINE_END.split(head)
+    method, target, version = request_line.split(b" ")
+    if not version.startswith(b"HTTP/"):
+        raise ValueError(f"Unknown protocol {version!r}.")
+
+    headers = {}
+    for line in lines:
+        name, separator, value = line.partition(b":")
+        if not separator:
+            raise ValueError(f"Malformed header {line!r}.")
+        headers[name.strip().lower()] = value.strip()
+    return method, target, version, headers
+
+
+def parse_authority(target: bytes) -> Tuple[str, int]:
+    """Parses "host:port" or "[IPv6 address]:port", raises ValueError if it
+    is not possible."""
+    host, separator, port = target.decode("ascii").rpartition(":")
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    elif ":" in host:
+        raise ValueError(f"IPv6 address {host!r} without brackets.")
+
+    port = int(port)
+    if not separator or not host or not 0 < port < 2 ** 16:
+        raise ValueError(f"Invalid target {target!r}.")
+    return host, port
+
+
+def wants_keep_alive(version: bytes, headers: Dict[bytes, bytes]) -> bool:
+    """Whether the client keeps the connection open after a response, as
+    said by the Connection or (older clients) Proxy-Connection header."""
+    options = {option.strip().lower()
+               for name in (b"connection", b"proxy-connection")
+               for option in headers.get(name, b"").split(b",")}
+    if b"close" in options:
+        return False
+    return version != b"HTTP/1.0" or b"keep-alive" in options
 
 
 class HttpConnectProxy(ProxyProtocol):
-    def __init__(self, loop: AbstractEventLoop):
+    """
+    Proxy for HTTP CONNECT requests.
+
+    The request is read until the end of its headers, bytes the client sent
+    right behind it (e.g. a TLS ClientHello, without waiting for the
+    response) are passed on to the tunnel. If the connection to the server
+    fails, a client which asked for it may send another request on the same
+    connection.
+    """
+    def __init__(self, loop: AbstractEventLoop, connector: Connector,
+                 max_header_size: int = DEFAULT_MAX_HEADER_SIZE):
         self.loop = loop
+        self.connector = connector
+        self.max_header_size = max_header_size
+        self.initial_data = b""
 
     @staticmethod
     def new(configuration: Mapping[str, Any], loop: AbstractEventLoop) \
             -> ProxyProtocol:
         """Creates a new simple proxy."""
-        return HttpConnectProxy(loop)
+        return HttpConnectProxy(
+            loop, get_connector(loop, configuration),
+            configuration.get("proxy", {}).get("max_header_size",
+                                               DEFAULT_MAX_HEADER_SIZE)
+        )
 
     async def proxy_handshake(self, connection: socket) -> Tuple[Tuple[str, int], socket]:
         """Handle an accepted connection. """
-        http_packet = await  self.loop.sock_recv(connection, 9000)
-
-        connect_line = http_packet.splitlines(False)[0]
-        verb, host, protocol = connect_line.split(b' ')
-
-        if verb.upper() != b"CONNECT":
-            await self.loop.sock_sendall(
-                connection,
-                b"HTTP/1.0 405 Invalid Request\r\n"
-                b"Content-Type: text/plain; charset=us-ascii\r\n"
-                b"Content-Length: 31\r\n"
-                b"Connection: Close\r\n"
-                b"\r\n"
-                b"This proxy only allows CONNECT."
-            )
-            return EMPTY_RESPONSE
-
-        host, port = host.split(b":")
-        port = int(port)
-
-        info = (await self.loop.getaddrinfo(host, 0, proto=IPPROTO_TCP))[0]
-        address = info[-1][0]
-        socket_family = info[0]
-
-        s = socket(socket_family)
-        s.setblocking(False)
-        await self.loop.sock_connect(s, (address, port))
-        await self.loop.sock_sendall(connection, b"HTTP/1.1 200 OK\r\n\r\n")
-        return (host, port), s
+        reader = HandshakeReader(self.loop, connection)
+        while True:
+            try:
+                head = await reader.read_until(HEADER_END,
+                                               self.max_header_size)
+            except IncompleteReadError:
+                return EMPTY_RESPONSE
+            except LimitOverrunError:
+                await self.respond(connection,
+                                   b"431 Request Header Fields Too Large",
+                                   "The request headers are too long.")
+                return EMPTY_RESPONSE
+
+            # Empty lines before a request are ignored (RFC 7230, 3.5).
+            head = head.strip(b"\r\n")
+            if not head:
+                continue
+
+            try:
+                verb, target, version, headers = parse_head(head)
+            except ValueError:
+                await self.respond(connection, b"400 Bad Request",
+                                   "Malformed request.")
+                return EMPTY_RESPONSE
+
+            if verb.upper() != b"CONNECT":
+                # The request may have a body, so the connection is closed.
+                await self.respond(connection, b"405 Method Not Allowed",
+                                   "This proxy only allows CONNECT.")
+                return EMPTY_RESPONSE
+
+            # Bytes behind the request are meant for the server, after them
+            # no other request can be read.
+            keep_alive = not reader.buffer and wants_keep_alive(version, headers)
+            try:
+                host, port = parse_authority(target)
+            except ValueError:
+                await self.respond(connection, b"400 Bad Request",
+                                   "The target must be host:port.",
+                                   keep_alive)
+                if keep_alive:
+                    continue
+                return EMPTY_RESPONSE
+
+            try:
+                s = await self.connector.connect(host, port)
+            except TimeoutError:
+                await self.respond(connection, b"504 Gateway Timeout",
+                                   f"Connecting to {host} timed out.",
+                                   keep_alive)
+            except OSError as e:
+                await self.respond(connection, b"502 Bad Gateway",
+                                   f"Could not connect to {host}: {e}",
+                                   keep_alive)
+            else:
+                await self.loop.sock_sendall(connection,
+                                             b"HTTP/1.1 200 OK\r\n\r\n")
+                self.initial_data = reader.remaining()
+                return (host, port), s
+
+            if not keep_alive:
+                return EMPTY_RESPONSE
 
+    async def respond(self, connection: socket, status: bytes, message: str,
+                      keep_alive: bool = False):
+        body = message.encode("ascii", "replace")
+        persistence = b"keep-alive" if keep_alive else b"close"
+        await self.loop.sock_sendall(
+            connection,
+            b"HTTP/1.1 " + status + b"\r\n"
+            b"Content-Type: text/plain; charset=us-ascii\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+            b"Connection: " + persistence + b"\r\n"
+            b"Proxy-Connection: " + persistence + b"\r\n"
+            b"\r\n" + body
+        )
@@ -0,0 +1,78 @@
+from asyncio import (AbstractEventLoop, IncompleteReadError,
+                     LimitOverrunError)
+from socket import socket
+from typing import Pattern, Union
+
+RECEIVE_SIZE = 4096
+
+
+class HandshakeReader:
+    """
+    Buffered reader for the proxy handshake of an accepted connection.
+
+    A handshake message may arrive split over several segments, or together
+    with the following messages and even the first bytes of the tunnel. The
+    reader only hands out whole messages, what it received beyond them is
+    kept and can be taken with remaining().
+
+    Raises asyncio.IncompleteReadError if the client closes the connection
+    before a message is complete.
+    """
+    def __init__(self, loop: AbstractEventLoop, connection: socket):
+        self.loop = loop
+        self.connection = connection
+        self.buffer = bytearray()
+
+    async def fill(self):
+        """Receives more bytes into the buffer."""
+        received = await self.loop.sock_recv(self.connection, RECEIVE_SIZE)
+        if not received:
+            raise IncompleteReadError(bytes(self.buffer), None)
+        self.buffer += received
+
+    async def read_exactly(self, n: int) -> bytes:
+        """Returns the next n bytes."""
+        while len(self.buffer) < n:
+            try:
+                await self.fill()
+            except IncompleteReadError as e:
+                raise IncompleteReadError(e.partial, n) from None
+
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def read_until(self, separator: Union[bytes, Pattern[bytes]],
+                         limit: int) -> bytes:
+        """Returns the bytes up to and including the separator, which may
+        also be a compiled regular expression.
+
+        Raises asyncio.LimitOverrunError if there is no separator within
+        the first limit bytes."""
+        searched = 0
+        while True:
+            if isinstance(separator, bytes):
+                # Only the tail of what was searched could start a match.
+                start = max(0, searched - len(separator) + 1)
+                index = self.buffer.find(separator, start)
+                end = -1 if index < 0 else index + len(separator)
+            else:
+                match = separator.search(self.buffer)
+                end = -1 if match is None else match.end()
+
+            if 0 <= end <= limit:
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            if end > limit or len(self.buffer) >= limit:
+                raise LimitOverrunError(
+                    f"No separator within the first {limit} bytes.", limit)
+
+            searched = len(self.buffer)
+            await self.fill()
+
+    def remaining(self) -> bytes:
+        """Takes what was received beyond the messages read so far."""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
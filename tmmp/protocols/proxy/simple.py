@@ -1,37 +1,34 @@
 from asyncio import AbstractEventLoop
-from socket import socket, AF_INET, AF_INET6, IPPROTO_TCP
+from socket import socket
 from typing import Any, Mapping, Tuple
 
+from ._empty import EMPTY_RESPONSE
 from .abc import ProxyProtocol
-from tmmp.util.ip import is_ipv4, is_ipv6
+from tmmp.connector import Connector, get_connector
 
 
 class SimpleProxy(ProxyProtocol):
-    def __init__(self, remote: Tuple[str, int], loop: AbstractEventLoop):
+    def __init__(self, remote: Tuple[str, int], loop: AbstractEventLoop,
+                 connector: Connector):
         self.remote = remote
         self.loop = loop
+        self.connector = connector
 
     @staticmethod
     def new(configuration: Mapping[str, Any], loop: AbstractEventLoop) \
             -> ProxyProtocol:
         """Creates a new simple proxy."""
-        return SimpleProxy(configuration["proxy"]["remote"], loop)
+        return SimpleProxy(configuration["proxy"]["remote"], loop,
+                           get_connector(loop, configuration))
 
     async def proxy_handshake(self, connection: socket) \
             -> Tuple[Tuple[str, int], socket]:
         """Handle an accepted connection."""
-        if is_ipv4(self.remote[0]):
-            s = socket(AF_INET)
-            remote = self.remote
-        elif is_ipv6(self.remote[0]):
-            s = socket(AF_INET6)
-            remote = self.remote
-        else:
-            info = (await self.loop.getaddrinfo(*self.remote, proto=IPPROTO_TCP))[0]
-            s = socket(*info[:2])
-            remote = info[-1][:2]
-
-        s.setblocking(False)
-        await self.loop.sock_connect(s, remote)
-
+        try:
+            s = await self.connector.connect(*self.remote)
+        except OSError as e:
+            # There is no way to tell the client, its connection is closed.
+            print(f"Could not connect to {self.remote[0]} port "
+                  f"{self.remote[1]}: {e}")
+            return EMPTY_RESPONSE
         return self.remote, s
@@ -1,12 +1,14 @@
-from asyncio import AbstractEventLoop
-from io import BytesIO
+from asyncio import (AbstractEventLoop, IncompleteReadError,
+                     LimitOverrunError)
 from ipaddress import ip_address
-from socket import socket, AF_INET, AF_INET6, IPPROTO_TCP
+from socket import socket, AF_INET, AF_INET6
 from struct import pack, unpack
 from typing import Any, Mapping, Tuple
 
 from ._empty import EMPTY_RESPONSE
 from .abc import ProxyProtocol
+from .reader import HandshakeReader
+from ...connector import Connector, get_connector
 
 
 SOCKS4_SUCCESS = b"\x5a"
@@ -17,130 +19,157 @@ SOCKS4_PADDING = 2 * b"\x00" + 4 * b"\xff"
 SOCKS5_SUCCESS = b"\x00"
 SOCKS5_EREJECT = b"\x01"
 SOCKS5_ERULES = b"\x02"
+SOCKS5_EUNREACHABLE = b"\x04"
+SOCKS5_EREFUSED = b"\x05"
 SOCKS5_EPROTOCOL = b"\x07"
 
 SOCKS5_PADDING = b"\x00" + b"\x01" + 4*b"\xff" + 2*b"\xff"
 
+# Most bytes the SOCKS4 user id and SOCKS4a hostname may have each.
+MAX_FIELD_SIZE = 256
+
 
 class SocksProxy(ProxyProtocol):
-    def __init__(self,loop: AbstractEventLoop):
+    def __init__(self, loop: AbstractEventLoop, connector: Connector):
         self.loop = loop
+        self.connector = connector
 
     @staticmethod
     def new(configuration: Mapping[str, Any], loop: AbstractEventLoop) \
             -> ProxyProtocol:
         """Creates a new SOCKS4/4a/5 proxy."""
-        return SocksProxy(loop)
+        return SocksProxy(loop, get_connector(loop, configuration))
 
     async def proxy_handshake(self, connection: socket) \
             -> Tuple[Tuple[str, int], socket]:
-        """Handle an accepted connection. """
-        packet = await self.loop.sock_recv(connection, 1024)
-        socks_ver = packet[0]
-        if socks_ver == 4:
-            command = packet[1]
-
-            if command != 0x01:  # 0x01 == TCP client
+        """Handle an accepted connection.
+
+        Clients may send the greeting, the request and the first data for
+        the server at once, the data is then the initial data of the
+        tunnel."""
+        reader = HandshakeReader(self.loop, connection)
+        try:
+            socks_ver = (await reader.read_exactly(1))[0]
+            if socks_ver == 4:
+                response = await self.socks4_handshake(connection, reader)
+            elif socks_ver == 5:
+                response = await self.socks5_handshake(connection, reader)
+            else:
+                # Socks response "request rejected or failed"
                 await self.loop.sock_sendall(connection, b"\x00" + SOCKS4_REJECT + SOCKS4_PADDING)
                 return EMPTY_RESPONSE
+        except IncompleteReadError:
+            return EMPTY_RESPONSE
 
-            port = unpack("!H", packet[2:4])[0]
-            ip = str(ip_address(packet[4:8]))
-
-            end_of_uid = packet.index(b"\x00", 8)  # SOCKS4 has a user id
+        if response is not EMPTY_RESPONSE:
+            self.initial_data = reader.remaining()
+        return response
 
+    async def socks4_handshake(self, connection: socket,
+                               reader: HandshakeReader) \
+            -> Tuple[Tuple[str, int], socket]:
+        command, port, packed_ip = unpack("!BH4s",
+                                          await reader.read_exactly(7))
+        ip = str(ip_address(packed_ip))
+        try:
+            await reader.read_until(b"\x00", MAX_FIELD_SIZE)  # SOCKS4 has a user id
             if ip.startswith("0.0.0"):  # SOCKS4a with name resolution is used.
-                domain_end = packet.index(b"\x00", end_of_uid+1)
-                ip = packet[end_of_uid+1:domain_end].decode()
-
-            s = socket()
-            s.setblocking(False)
-
-            # Note: Linters might detect a type mismatch in the next line.
-            #       They complain about the second argument of sock_connect.
-            #       In this case, they are wrong.
-            #       The second argument is taking a (str, int)-tuple,
-            #       and not a str!
-            await self.loop.sock_connect(s, (ip, port))
-            out_ip, out_port = s.getsockname()
-
-            # Instead of padding send
-            await self.loop.sock_sendall(
-                connection,
-                b"\x00" + SOCKS4_SUCCESS +
-                pack("!H", out_port) + ip_address(out_ip).packed
-            )
+                ip = (await reader.read_until(b"\x00", MAX_FIELD_SIZE))[:-1].decode()
+        except (LimitOverrunError, UnicodeDecodeError):
+            command = None
 
-            return (ip, port), s
+        if command != 0x01:  # 0x01 == TCP client
+            await self.loop.sock_sendall(connection, b"\x00" + SOCKS4_REJECT + SOCKS4_PADDING)
+            return EMPTY_RESPONSE
 
-        elif socks_ver == 5:
-            auth_methods_length = packet[1]
+        try:
+            s = await self.connector.connect(ip, port)
+        except OSError:
+            await self.loop.sock_sendall(connection, b"\x00" + SOCKS4_REJECT + SOCKS4_PADDING)
+            return EMPTY_RESPONSE
+        out_ip, out_port = s.getsockname()[:2]
 
-            # 0 = No authentication
-            if b"\x00" not in packet[2:2+auth_methods_length]:
-                await self.loop.sock_sendall(connection, b"\x05" + b"\xff")
-                return EMPTY_RESPONSE
+        # Instead of padding send, the reply can only hold an IPv4
+        # address.
+        await self.loop.sock_sendall(
+            connection,
+            b"\x00" + SOCKS4_SUCCESS + pack("!H", out_port) +
+            (ip_address(out_ip).packed if s.family == AF_INET
+             else bytes(4))
+        )
 
-            # Return no authentication was selected
-            await self.loop.sock_sendall(connection, b"\x05" + b"\x00")
+        return (ip, port), s
 
-            socks_packet = BytesIO(await self.loop.sock_recv(connection, 1024))
-            if socks_packet.read(1) != b"\x05":  # Not SOCKS5
-                await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_EPROTOCOL + SOCKS5_EPROTOCOL)
-                return EMPTY_RESPONSE
+    async def socks5_handshake(self, connection: socket,
+                               reader: HandshakeReader) \
+            -> Tuple[Tuple[str, int], socket]:
+        auth_methods_length = (await reader.read_exactly(1))[0]
 
-            command = socks_packet.read(1)
-            if command in (b"\x03", b"\x04"):  # TCP server, UDP client
-                await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_ERULES + SOCKS5_EPROTOCOL)
-                return EMPTY_RESPONSE
+        # 0 = No authentication
+        if b"\x00" not in await reader.read_exactly(auth_methods_length):
+            await self.loop.sock_sendall(connection, b"\x05" + b"\xff")
+            return EMPTY_RESPONSE
 
-            socks_packet.read(1)  # Reserved byte
-            address_type = socks_packet.read(1)
-
-            if address_type == b"\x01":  # IPv4
-                address = str(
-                    ip_address(socks_packet.read(4))
-                )
-                socket_family = AF_INET
-            elif address_type == b"\x03":  # DNS
-                domain_size = socks_packet.read(1)[0]
-                domain = socks_packet.read(domain_size).decode()
-                info = (await self.loop.getaddrinfo(domain, 0, proto=IPPROTO_TCP))[0]
-                address = info[-1][0]
-                socket_family = info[0]
-
-            elif address_type == b"\x04":  # IPv6
-                address = str(ip_address(socks_packet.read(16)))
-                socket_family = AF_INET6
-            else:
-                await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_ERULES + SOCKS5_EPROTOCOL)
-                return EMPTY_RESPONSE
+        # Return no authentication was selected
+        await self.loop.sock_sendall(connection, b"\x05" + b"\x00")
 
-            port = unpack("!H", socks_packet.read(2))[0]
+        # Version, command, reserved byte and address type.
+        socks_packet = await reader.read_exactly(4)
+        if socks_packet[0:1] != b"\x05":  # Not SOCKS5
+            await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_EPROTOCOL + SOCKS5_EPROTOCOL)
+            return EMPTY_RESPONSE
 
-            s = socket(socket_family)
-            s.setblocking(False)
+        command = socks_packet[1:2]
+        if command in (b"\x03", b"\x04"):  # TCP server, UDP client
+            await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_ERULES + SOCKS5_EPROTOCOL)
+            return EMPTY_RESPONSE
 
-            # Linters can be wrong about the following line:
-            await self.loop.sock_connect(s, (address, port))
+        address_type = socks_packet[3:4]
 
-            if socket_family == AF_INET6:
-                out_ip, out_port, _, _ = s.getsockname()
-            else:
-                out_ip, out_port = s.getsockname()
-
-            await self.loop.sock_sendall(
-                connection,
-                b"\x05" +
-                SOCKS5_SUCCESS +
-                b"\x00" +  # Reserved
-                (b"\x01" if socket_family == AF_INET else b"\x04") +
-                ip_address(out_ip).packed +
-                pack("!H", out_port)
+        if address_type == b"\x01":  # IPv4
+            host = str(
+                ip_address(await reader.read_exactly(4))
             )
-            return (address, port), s
+        elif address_type == b"\x03":  # DNS
+            domain_size = (await reader.read_exactly(1))[0]
+            try:
+                host = (await reader.read_exactly(domain_size)).decode()
+            except UnicodeDecodeError:
+                # Can not be a hostname.
+                await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_EUNREACHABLE + SOCKS5_PADDING)
+                return EMPTY_RESPONSE
 
+        elif address_type == b"\x04":  # IPv6
+            host = str(ip_address(await reader.read_exactly(16)))
         else:
-            # Socks response "request rejected or failed"
-            await self.loop.sock_sendall(connection, b"\x00" + SOCKS4_REJECT + SOCKS4_PADDING)
+            await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_ERULES + SOCKS5_EPROTOCOL)
             return EMPTY_RESPONSE
+
+        port = unpack("!H", await reader.read_exactly(2))[0]
+
+        try:
+            s = await self.connector.connect(host, port)
+        except ConnectionRefusedError:
+            await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_EREFUSED + SOCKS5_PADDING)
+            return EMPTY_RESPONSE
+        except OSError:
+            # Not resolved, timed out or no address reachable.
+            await self.loop.sock_sendall(connection, b"\x05" + SOCKS5_EUNREACHABLE + SOCKS5_PADDING)
+            return EMPTY_RESPONSE
+        socket_family = s.family
+
+        if socket_family == AF_INET6:
+            out_ip, out_port, _, _ = s.getsockname()
+        else:
+            out_ip, out_port = s.getsockname()
+
+        await self.loop.sock_sendall(
+            connection,
+            b"\x05" +
+            SOCKS5_SUCCESS +
+            b"\x00" +  # Reserved
+            (b"\x01" if socket_family == AF_INET else b"\x04") +
+            ip_address(out_ip).packed +
+            pack("!H", out_port)
+        )
+        return (host, port), s
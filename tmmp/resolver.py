@@ -0,0 +1,399 @@
+"""
+Resolves the hostnames clients ask the proxy for, shared by all proxy
+protocols of an event loop.
+
+Answers are cached for their TTL, failures for a shorter negative TTL, and
+concurrent lookups of the same name wait for the same query. By default the
+system resolver is asked (getaddrinfo() in the default executor, without
+TTLs), with a configured name server the queries are sent over UDP from the
+event loop itself.
+"""
+import asyncio
+import ipaddress
+import random
+import socket
+import struct
+import time
+
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
+
+from .util.ip import is_ipv4, is_ipv6
+from .util.lru import LruCache
+
+DEFAULT_CACHE_SIZE = 4096
+# Seconds answers of the system resolver are kept, also the longest any
+# answer is kept.
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 10
+# Seconds until an unanswered query is sent again, it is given up after
+# ATTEMPTS times.
+DEFAULT_TIMEOUT = 1.0
+ATTEMPTS = 2
+DNS_PORT = 53
+DEFAULT_STATS_INTERVAL = 5 * 60
+
+# (family, address) in the order they should be tried.
+Addresses = List[Tuple[int, str]]
+
+HEADER = struct.Struct("!HHHHHH")
+RECORD = struct.Struct("!HHIH")
+QUESTION = struct.Struct("!HH")
+FLAG_RESPONSE = 0x8000
+FLAG_RECURSION_DESIRED = 0x0100
+RCODE_NXDOMAIN = 3
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+CLASS_IN = 1
+
+
+def _not_found(host: str) -> socket.gaierror:
+    return socket.gaierror(socket.EAI_NONAME,
+                           f"Name or service not known: {host}")
+
+
+def _temporary_failure(host: str) -> socket.gaierror:
+    return socket.gaierror(socket.EAI_AGAIN,
+                           f"Temporary failure in name resolution: {host}")
+
+
+class Resolver:
+    """
+    Resolves hostnames to addresses, raises socket.gaierror like
+    getaddrinfo() if that is not possible.
+    """
+    ttl: float
+    negative_ttl: float
+    # (address, port) of the name server, None uses the system resolver.
+    nameserver: Optional[Tuple[str, int]]
+    timeout: float
+    # Seconds between the statistics lines, 0 never prints them.
+    stats_interval: float
+    # Lookups answered from the cache, by waiting for another one, or sent.
+    hits: int
+    joined: int
+    misses: int
+    # Seconds all sent lookups took together.
+    lookup_time: float
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE,
+                 ttl: float = DEFAULT_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 nameserver: Optional[Tuple[str, int]] = None,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 loop: asyncio.AbstractEventLoop = None,
+                 stats_interval: float = 0):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+
+        # hostname -> (addresses or the error, expiry time)
+        self.cache: LruCache[str, Tuple[Union[Addresses, socket.gaierror],
+                                        float]] = LruCache(cache_size)
+        self.pending: Dict[str, asyncio.Task] = {}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.nameserver = nameserver
+        self.timeout = timeout
+        self.stats_interval = stats_interval
+
+        self.hits = 0
+        self.joined = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any],
+                    loop: asyncio.AbstractEventLoop = None) -> "Resolver":
+        """Creates the resolver from the [dns] section."""
+        nameserver = config.get("nameserver")
+        if nameserver is not None:
+            nameserver = parse_nameserver(nameserver)
+
+        return cls(config.get("cache_size", DEFAULT_CACHE_SIZE),
+                   config.get("ttl", DEFAULT_TTL),
+                   config.get("negative_ttl", DEFAULT_NEGATIVE_TTL),
+                   nameserver,
+                   config.get("timeout", DEFAULT_TIMEOUT),
+                   loop,
+                   config.get("stats_interval", DEFAULT_STATS_INTERVAL))
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of the lookups which did not send a query."""
+        lookups = self.hits + self.joined + self.misses
+        return (self.hits + self.joined) / lookups if lookups else 0.0
+
+    @property
+    def average_latency(self) -> float:
+        """Seconds a sent lookup took on average."""
+        return self.lookup_time / self.misses if self.misses else 0.0
+
+    def statistics(self) -> str:
+        return (f"cache hit ratio {self.hit_ratio:.0%} of "
+                f"{self.hits + self.joined + self.misses} lookups, average "
+                f"lookup {self.average_latency * 1000:.1f} ms")
+
+    async def report_statistics(self):
+        """Prints the statistics every stats_interval seconds."""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            print(f"DNS: {self.statistics()}")
+
+    async def resolve(self, host: Union[str, bytes]) -> Addresses:
+        """Returns the addresses of the host, IP addresses are returned
+        without a lookup."""
+        if isinstance(host, bytes):
+            host = host.decode("ascii", "replace")
+
+        if is_ipv4(host):
+            return [(socket.AF_INET, host)]
+        if is_ipv6(host):
+            return [(socket.AF_INET6, host)]
+
+        host = host.lower().rstrip(".")
+        entry = self.cache.get(host)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.hits += 1
+                return self.result(entry[0])
+            del self.cache[host]
+
+        task = self.pending.get(host)
+        if task is None:
+            self.misses += 1
+            # Not cancelled with the connection which started it.
+            task = self.pending[host] = self.loop.create_task(
+                self.lookup(host))
+        else:
+            self.joined += 1
+        return self.result(await asyncio.shield(task))
+
+    @staticmethod
+    def result(entry: Union[Addresses, socket.gaierror]) -> Addresses:
+        if isinstance(entry, socket.gaierror):
+            # A new exception, so the tracebacks do not pile up.
+            raise socket.gaierror(*entry.args)
+        return entry
+
+    async def lookup(self, host: str) -> Union[Addresses, socket.gaierror]:
+        """Asks the system resolver or name server and caches the result,
+        which is returned even if it is an error."""
+        start = time.monotonic()
+        try:
+            if self.nameserver is None:
+                addresses, ttl = await self.getaddrinfo(host), self.ttl
+            else:
+                addresses, ttl = await self.query(host)
+            entry = addresses
+            if not addresses:
+                entry, ttl = _not_found(host), min(ttl, self.negative_ttl)
+        except socket.gaierror as e:
+            # Temporary failures are not cached.
+            entry = e
+            ttl = 0 if e.errno == socket.EAI_AGAIN else self.negative_ttl
+        finally:
+            del self.pending[host]
+
+        elapsed = time.monotonic() - start
+        self.lookup_time += elapsed
+        if ttl > 0:
+            self.cache[host] = entry, start + min(ttl, self.ttl)
+        return entry
+
+    async def getaddrinfo(self, host: str) -> Addresses:
+        infos = await self.loop.getaddrinfo(host, 0, type=socket.SOCK_STREAM,
+                                            proto=socket.IPPROTO_TCP)
+        addresses = []
+        for family, *_, address in infos:
+            if (family, address[0]) not in addresses:
+                addresses.append((family, address[0]))
+        return addresses
+
+    async def query(self, host: str) -> Tuple[Addresses, float]:
+        """Asks the name server for the AAAA and A records of the host.
+
+        If only one of the queries fails, the addresses of the other one are
+        returned, but kept no longer than the negative TTL.
+
+        :return: The addresses (none if the host does not exist) and how
+                 many seconds they may be cached.
+        """
+        try:
+            name = b"".join(bytes((len(label),)) + label
+                            for label in host.encode("idna").split(b"."))
+        except UnicodeError:
+            raise _not_found(host) from None
+
+        queries = {}
+        for record_type in (TYPE_AAAA, TYPE_A):
+            query_id = random.getrandbits(16)
+            while query_id in queries:
+                query_id = random.getrandbits(16)
+            queries[query_id] = (
+                HEADER.pack(query_id, FLAG_RECURSION_DESIRED, 1, 0, 0, 0) +
+                name + b"\x00" + QUESTION.pack(record_type, CLASS_IN)
+            )
+
+        answers: Dict[int, asyncio.Future] = {
+            query_id: self.loop.create_future() for query_id in queries
+        }
+        try:
+            transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _DnsProtocol(answers), remote_addr=self.nameserver)
+        except OSError:
+            raise _temporary_failure(host) from None
+        try:
+            for _ in range(ATTEMPTS):
+                waiting = [query_id for query_id, answer in answers.items()
+                           if not answer.done()]
+                if not waiting:
+                    break
+                for query_id in waiting:
+                    transport.sendto(queries[query_id])
+                await asyncio.wait([answers[query_id] for query_id in waiting],
+                                   timeout=self.timeout)
+        finally:
+            transport.close()
+
+        addresses: Addresses = []
+        ttls = []
+        failed = False
+        for answer in answers.values():
+            if not answer.done() or answer.result() is None:
+                failed = True
+                continue
+            try:
+                found, ttl = parse_response(answer.result())
+            except (OSError, ValueError, IndexError, struct.error):
+                # E.g. SERVFAIL or a malformed response.
+                failed = True
+                continue
+
+            addresses += found
+            if ttl is not None:
+                ttls.append(ttl)
+
+        if failed:
+            # The failed query may have had the only addresses.
+            if not addresses:
+                raise _temporary_failure(host)
+            ttls.append(self.negative_ttl)
+
+        return addresses, min(ttls) if ttls else self.negative_ttl
+
+
+class _DnsProtocol(asyncio.DatagramProtocol):
+    """Sets the future of a query id to its response, to None if the
+    query failed."""
+    def __init__(self, answers: Dict[int, asyncio.Future]):
+        self.answers = answers
+
+    def datagram_received(self, data: bytes, _):
+        if len(data) < HEADER.size:
+            return
+        answer = self.answers.get(HEADER.unpack_from(data)[0])
+        if answer is not None and not answer.done():
+            answer.set_result(data)
+
+    def error_received(self, exc: Exception):
+        # E.g. ICMP port unreachable, the name server is not running.
+        for answer in self.answers.values():
+            if not answer.done():
+                answer.set_result(None)
+
+
+def _skip_name(message: bytes, offset: int) -> int:
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += 1 + length
+        if not length:
+            return offset
+
+
+def parse_response(message: bytes) -> Tuple[Addresses, Optional[float]]:
+    """Returns the addresses of an A or AAAA response (none if the name
+    does not exist) and the TTL of the answer, None if it has none.
+
+    Raises OSError for failed queries."""
+    _, flags, questions, answers, authorities, _ = \
+        HEADER.unpack_from(message)
+    if not flags & FLAG_RESPONSE:
+        raise ValueError("Not a DNS response.")
+
+    rcode = flags & 0xf
+    if rcode not in (0, RCODE_NXDOMAIN):
+        raise OSError(f"DNS query failed with rcode {rcode}.")
+
+    offset = HEADER.size
+    for _ in range(questions):
+        offset = _skip_name(message, offset) + QUESTION.size
+
+    # A truncated response still has the records which fit, which are
+    # enough to connect.
+    addresses: Addresses = []
+    ttls = []
+    for index in range(answers + authorities):
+        offset = _skip_name(message, offset)
+        record_type, record_class, ttl, length = \
+            RECORD.unpack_from(message, offset)
+        offset += RECORD.size
+        data = message[offset:offset + length]
+        offset += length
+
+        if index < answers:
+            if record_class != CLASS_IN:
+                continue
+            if record_type == TYPE_A and length == 4:
+                addresses.append((socket.AF_INET,
+                                  str(ipaddress.IPv4Address(data))))
+                ttls.append(ttl)
+            elif record_type == TYPE_AAAA and length == 16:
+                addresses.append((socket.AF_INET6,
+                                  str(ipaddress.IPv6Address(data))))
+                ttls.append(ttl)
+        elif record_type == TYPE_SOA and not addresses:
+            # RFC 2308: negative answers are cached for the SOA's TTL or
+            # minimum, whichever is lower.
+            minimum = struct.unpack("!I", data[-4:])[0]
+            ttls.append(min(ttl, minimum))
+
+    if rcode == RCODE_NXDOMAIN:
+        addresses = []
+    return addresses, min(ttls) if ttls else None
+
+
+def parse_nameserver(nameserver: str) -> Tuple[str, int]:
+    """Parses "address", "address:port" or "[IPv6 address]:port"."""
+    if nameserver.startswith("["):
+        address, _, port = nameserver[1:].partition("]:")
+        return address.rstrip("]"), int(port or DNS_PORT)
+    if nameserver.count(":") == 1:
+        address, port = nameserver.split(":")
+        return address, int(port)
+    return nameserver, DNS_PORT
+
+
+_resolvers: "WeakKeyDictionary[asyncio.AbstractEventLoop, Resolver]" = \
+    WeakKeyDictionary()
+
+
+def get_resolver(loop: asyncio.AbstractEventLoop = None,
+                 configuration: Optional[Mapping[str, Any]] = None) \
+        -> Resolver:
+    """Returns the resolver of the given (or current) event loop, it is
+    created from the [dns] section of the configuration on first use, which
+    also starts its statistics report."""
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    resolver = _resolvers.get(loop)
+    if resolver is None:
+        resolver = _resolvers[loop] = Resolver.from_config(
+            (configuration or {}).get("dns", {}), loop)
+        if resolver.stats_interval > 0:
+            loop.create_task(resolver.report_statistics())
+    return resolver
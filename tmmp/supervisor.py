@@ -0,0 +1,192 @@
+"""
+Runs the proxy in several worker processes.
+
+Every worker has its own event loop and (if the platform supports
+SO_REUSEPORT) its own listening socket, so the kernel balances the incoming
+connections between them. Everything created before the workers are forked,
+like the certificate manager and its keys, is shared by all workers.
+
+Workers send heartbeats through a pipe. The supervisor restarts workers which
+exited or whose event loop stopped sending heartbeats.
+"""
+import asyncio
+import os
+import selectors
+import signal
+import sys
+import time
+import traceback
+
+from contextlib import suppress
+from typing import Callable, Dict, Optional
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+# Minimum time between two starts of the same worker.
+RESTART_DELAY = 1.0
+SHUTDOWN_TIMEOUT = 5.0
+
+
+async def send_heartbeats(fd: int, interval: float = HEARTBEAT_INTERVAL):
+    """Tells the supervisor the event loop of this worker is alive."""
+    os.set_blocking(fd, False)
+
+    while True:
+        try:
+            os.write(fd, b"\0")
+        except BlockingIOError:  # The supervisor is busy, that is fine.
+            pass
+        await asyncio.sleep(interval)
+
+
+class Worker:
+    index: int
+    pid: int
+    heartbeat: int
+    started: float
+    last_seen: float
+
+    def __init__(self, index: int, pid: int, heartbeat: int):
+        self.index = index
+        self.pid = pid
+        self.heartbeat = heartbeat
+        self.started = self.last_seen = time.monotonic()
+
+
+class Supervisor:
+    """
+    Forks and monitors the worker processes.
+
+    The target is called in each worker with the worker index and the file
+    descriptor to send heartbeats to, it should not return.
+    """
+    workers: Dict[int, Worker]
+    # Worker index -> when to start it again.
+    restarts: Dict[int, float]
+
+    def __init__(self, target: Callable[[int, int], None], count: int,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT):
+        self.target = target
+        self.count = count
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.workers = {}
+        self.restarts = {}
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+
+    def run(self):
+        """Starts all workers and supervises them until SIGINT or SIGTERM."""
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for index in range(self.count):
+            self.spawn(index)
+
+        try:
+            while not self.stopping:
+                self.monitor()
+        finally:
+            self.shutdown()
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def spawn(self, index: int):
+        read_end, write_end = os.pipe()
+        # Otherwise buffered output would be written by both processes.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+
+        if pid == 0:  # Worker
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.close(read_end)
+            for worker in self.workers.values():
+                os.close(worker.heartbeat)
+            self.selector.close()
+
+            status = 0
+            try:
+                self.target(index, write_end)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+
+        os.close(write_end)
+        worker = self.workers[index] = Worker(index, pid, read_end)
+        self.selector.register(read_end, selectors.EVENT_READ, worker)
+        print(f"Started worker {index} (pid {pid}).")
+
+    def monitor(self):
+        """Processes heartbeats, dead and hanging workers once."""
+        for key, _ in self.selector.select(timeout=1):
+            if os.read(key.fd, 1024):
+                key.data.last_seen = time.monotonic()
+
+        now = time.monotonic()
+        self.reap()
+
+        for worker in self.workers.values():
+            if now - worker.last_seen > self.heartbeat_timeout:
+                print(f"Worker {worker.index} (pid {worker.pid}) stopped "
+                      f"sending heartbeats, killing it.")
+                with suppress(ProcessLookupError):
+                    os.kill(worker.pid, signal.SIGKILL)
+                # Prevents killing it again before it is reaped.
+                worker.last_seen = now
+
+        for index, when in list(self.restarts.items()):
+            if when <= now and not self.stopping:
+                del self.restarts[index]
+                self.spawn(index)
+
+    def reap(self):
+        """Collects exited workers and schedules their restart."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            worker = self.find_worker(pid)
+            if worker is None:
+                continue
+
+            print(f"Worker {worker.index} (pid {pid}) exited with status "
+                  f"{status}.")
+            self.selector.unregister(worker.heartbeat)
+            os.close(worker.heartbeat)
+            del self.workers[worker.index]
+
+            self.restarts[worker.index] = max(
+                time.monotonic(), worker.started + RESTART_DELAY)
+
+    def find_worker(self, pid: int) -> Optional[Worker]:
+        for worker in self.workers.values():
+            if worker.pid == pid:
+                return worker
+        return None
+
+    def shutdown(self):
+        """Terminates all workers, kills them if they do not exit in time."""
+        for worker in self.workers.values():
+            with suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(.1)
+
+        for worker in self.workers.values():
+            with suppress(ProcessLookupError):
+                os.kill(worker.pid, signal.SIGKILL)
+        self.restarts.clear()
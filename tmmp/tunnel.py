@@ -1,150 +1,356 @@
-from asyncio import get_event_loop, sleep, wait_for, AbstractEventLoop, Lock, \
-    TimeoutError
-from io import BytesIO
+from asyncio import get_event_loop, wait_for, AbstractEventLoop, Event, \
+    TimeoutError as WaitTimeout
+from enum import Enum
 from pathlib import Path
-from time import time
-from typing import Collection
+from time import localtime, strftime, time
+from typing import Collection, Optional, Union
+from zlib import crc32
 
 from .aiosock.abc import AbstractAioSocket
-from .defaults import PCAP_PATH
-from .pcap import PacketWriter
+from .aiosock.buffer import get_buffer_pool
+from .passthrough import relay
+from .pcap import PacketWriter, RecordSink
 from .protocols.application.abc import ApplicationProtocol
 
-from scapy.all import PcapWriter
+
+# Seconds the client may take to send the rest of a first packet which
+# arrived split, before it is forwarded as it is.
+FIRST_PACKET_TIMEOUT = 5.0
+
+
+class TunnelState(str, Enum):
+    FORWARDING = "forwarding"
+    # The client to server direction is switching protocols, the other
+    # direction must not touch the sockets until the handoff is done.
+    HANDOFF = "handoff"
+    # Both directions are relayed by the kernel (see passthrough.py).
+    PASSTHROUGH = "passthrough"
+    CLOSED = "closed"
 
 
 class Tunnel:
-    active: bool
+    """
+    Forwards data between a client and a server socket.
+
+    Each direction is pumped by its own task, which only wakes up if its
+    socket is readable. Data is received into pooled buffers and forwarded
+    as memoryview slices, a buffer is only held while its data is in flight.
+
+    If the client starts a protocol known by one of the application
+    protocols, the client to server task parks the other direction
+    (HANDOFF), wraps both sockets and resumes forwarding.
+
+    Tunnels without capture can be relayed by the kernel (PASSTHROUGH) once
+    it is clear they will not be intercepted, i.e. the first client packet
+    did not start any application protocol (see complete_first_packet()).
+    Protocols the client starts later, like with STARTTLS, are not
+    intercepted then.
+
+    Data the client sent together with the proxy handshake (initial_data)
+    is handled like the first packet received from it. If it may be the
+    start of a split protocol packet (see ApplicationProtocol.missing_bytes),
+    the rest is received before the protocols look at it.
+    """
+    state: TunnelState
     protocols: Collection[ApplicationProtocol]
     maximum_protocol_depth = 1
     protocol_depth = 0
+    chunk_size = 9000
     client_active: bool = True
     server_active: bool = True
-    writer: PacketWriter
+    passthrough: bool
+    # A PacketWriter, or what the capture target returns with its interface.
+    writer: Optional[PacketWriter]
     pcap_filename: Path
 
     def __init__(self, client: AbstractAioSocket, server: AbstractAioSocket,
                  protocols: Collection[ApplicationProtocol] = (),
-                 loop: AbstractEventLoop = None, write_to: PcapWriter = None):
+                 loop: AbstractEventLoop = None, write_to: RecordSink = None,
+                 passthrough: bool = False, capture_limit: int = 0,
+                 initial_data: bytes = b""):
+        """
+        :param write_to: Where to capture the data to (a RecordSink or a
+                         SidecarCapture), None disables capture.
+        :param capture_limit: Only capture this many bytes of both
+                              directions, 0 captures everything.
+        :param passthrough: Whether the kernel relay may be used if possible.
+        :param initial_data: Client data the proxy protocol already received.
+        """
 
         self.client = client
         self.server = server
+        self.initial_data = initial_data
 
-        self.client_to_server = Lock()
-        self.server_to_client = Lock()
-
-        self.active = True
+        self.state = TunnelState.FORWARDING
         self.protocols = protocols
+        self.passthrough = passthrough
+        # Whether the first client packet was seen and started no protocol.
+        self.inspected = False
+
+        # Set by the server to client task once it stopped using the
+        # sockets, set by the client to server task once the handoff is done
+        # (or when the tunnel is closed).
+        self.server_parked = Event()
+        self.handoff_done = Event()
 
         self.loop = loop
         if loop is None:
             self.loop = get_event_loop()
+        self.buffers = get_buffer_pool(self.loop)
 
-        server_info = Tunnel.ip_to_ipv6(
-            server.get_real_socket().getpeername()[0]
-        ), server.get_real_socket().getpeername()[1]
-        client_info = Tunnel.ip_to_ipv6(
-            client.get_real_socket().getpeername()[0]
-        ), client.get_real_socket().getpeername()[1]
+        self.writer = None
+        if write_to is not None:
+            server_info = Tunnel.ip_to_ipv6(
+                server.get_real_socket().getpeername()[0]
+            ), server.get_real_socket().getpeername()[1]
+            client_info = Tunnel.ip_to_ipv6(
+                client.get_real_socket().getpeername()[0]
+            ), client.get_real_socket().getpeername()[1]
 
-        if write_to is None:
-            write_to = PcapWriter(BytesIO())
+            self.writer = write_to.flow_writer(
+                client_info,
+                server_info,
+                Tunnel.new_pcap_name(
+                    "{}:{}".format(*client_info), "{}:{}".format(*server_info)
+                ),
+                capture_limit
+            )
 
-        self.writer = PacketWriter(
-            client_info,
-            server_info,
-            write_to
-        )
+    @property
+    def active(self) -> bool:
+        return self.state != TunnelState.CLOSED
 
     def schedule(self):
         self.loop.create_task(self.communicate_client_to_server())
         self.loop.create_task(self.communicate_server_to_client())
 
+    def close(self):
+        """Stops both directions. Sockets are closed by their tasks."""
+        if self.state == TunnelState.CLOSED:
+            return
+
+        self.state = TunnelState.CLOSED
+        if self.writer is not None:
+            self.stop_capture()
+        self.server_parked.set()
+        self.handoff_done.set()
+        self.client.interrupt_wait()
+        self.server.interrupt_wait()
+
     async def communicate_client_to_server(self):
-        while self.active:
-            async with self.client_to_server:
+        try:
+            if self.initial_data:
+                data, self.initial_data = self.initial_data, b""
+                await self.forward_from_client(memoryview(data))
+                if self.writer is not None:
+                    await self.writer.drain()
+
+            while self.state != TunnelState.CLOSED:
+                if self.can_pass_through():
+                    await self.pass_through()
+                    break
+
+                await self.client.wait_readable()
+                if self.state == TunnelState.CLOSED:
+                    break
+
+                buffer = self.buffers.acquire()
                 try:
-                    # Wait 20ms for packet
-                    data = await wait_for(self.client.recv(9000), .02)
-                except TimeoutError:  # Can happen
-                    continue
-                except:  # TODO: Be more specific
-                    self.active = False
-                    raise
-
-                # print("C:", data)
-
-                # Todo: Uhm... make it better.
-                do_not_send = False
-                if self.protocol_depth < self.maximum_protocol_depth:
-
-                    for protocol in self.protocols:
-                        if protocol.is_protocol_packet(data):
-                            # Avoid any communication
-                            try:
-                                async with self.server_to_client:
-                                    self.client, self.server = \
-                                        await protocol.wrap_connection(
-                                            data,
-                                            self.client,
-                                            self.server,
-                                            self.loop
-                                        )
-                            except Exception:  # Todo...
-                                self.active = False
-                                raise
-
-                            self.protocol_depth += 1
-                            do_not_send = True
-                            break
-                    if do_not_send:
-                        continue
-
-                if data:
-                    # self.client_active = True
-                    await self.server.sendall(data)
-                    self.writer.server(data)
-
-                else:
-                    self.active = False
-
-        self.client.get_real_socket().close()
+                    data = memoryview(buffer)[:self.chunk_size]
+                    received = await self.client.recv_into(data)
+                    if not received:
+                        break
+                    await self.forward_from_client(data[:received])
+                finally:
+                    self.buffers.release(buffer)
+                # Capture backpressure, without holding the buffer.
+                if self.writer is not None:
+                    await self.writer.drain()
+        finally:
+            self.close()
+            await self.release(self.client)
+
+    async def forward_from_client(self, data: memoryview):
+        """Hands the sockets off if the data starts a protocol, otherwise
+        sends it to the server (and captures it)."""
+        if self.protocol_depth < self.maximum_protocol_depth:
+            if not self.inspected:
+                data = await self.complete_first_packet(data)
+            protocol = self.find_protocol(data)
+            if protocol is not None:
+                # The protocol may keep the packet, so copy it.
+                await self.handoff(protocol, bytes(data))
+                return
+        self.inspected = True
+
+        await self.server.sendall(data)
+        if self.writer is not None:
+            self.writer.server(data)
+            if self.writer.exhausted:
+                self.stop_capture()
 
     async def communicate_server_to_client(self):
-        while self.active:
-            async with self.server_to_client:
-                try:
-                    # Wait 20ms for transmission
-                    # (this means the lock will be released at least every 20ms)
-                    data = await wait_for(self.server.recv(9000), .02)
-                except TimeoutError:  # Can happen
+        try:
+            while self.state != TunnelState.CLOSED:
+                if self.state in (TunnelState.HANDOFF,
+                                  TunnelState.PASSTHROUGH):
+                    self.server_parked.set()
+                    await self.handoff_done.wait()
+                    continue
+
+                await self.server.wait_readable()
+                if self.state != TunnelState.FORWARDING:
                     continue
-                except:  # TODO: Be more specific
-                    self.active = False
-                    raise
 
-                if data:
+                buffer = self.buffers.acquire()
+                try:
+                    data = memoryview(buffer)[:self.chunk_size]
+                    received = await self.server.recv_into(data)
+                    if not received:
+                        break
+                    data = data[:received]
+
                     await self.client.sendall(data)
-                    self.writer.client(data)
+                    if self.writer is not None:
+                        self.writer.client(data)
+                        if self.writer.exhausted:
+                            self.stop_capture()
+                finally:
+                    self.buffers.release(buffer)
+                # Capture backpressure, without holding the buffer.
+                if self.writer is not None:
+                    await self.writer.drain()
+        finally:
+            self.close()
+            await self.release(self.server)
+
+    @staticmethod
+    async def release(sock: AbstractAioSocket):
+        """Closes the socket the calling task reads from.
+
+        The other task writes to it, so what that task held back (see
+        write_coalescing_window) is sent first, followed by the end of a
+        TLS connection."""
+        try:
+            await sock.shutdown()
+        except OSError:
+            # The peer is gone, there is no one to send it to.
+            pass
+        sock.get_real_socket().close()
+
+    def stop_capture(self):
+        """Stops capturing, so the tunnel may be relayed by the kernel."""
+        self.writer.close()
+        self.writer = None
+
+    async def complete_first_packet(self, data: memoryview) -> memoryview:
+        """Receives the rest of a protocol packet the client started, e.g.
+        a ClientHello split over several segments, so the protocols see it
+        whole."""
+        missing = max((protocol.missing_bytes(data)
+                       for protocol in self.protocols), default=0)
+        if not missing:
+            return data
+
+        packet = bytearray(data)
+        while missing:
+            try:
+                await wait_for(self.client.wait_readable(),
+                               FIRST_PACKET_TIMEOUT)
+            except WaitTimeout:
+                break
+            if self.state == TunnelState.CLOSED:
+                break
+            received = await self.client.recv(missing)
+            if not received:
+                break
+            packet += received
+            missing = max(protocol.missing_bytes(packet)
+                          for protocol in self.protocols)
+        return memoryview(packet)
+
+    def find_protocol(self, packet: Union[bytes, memoryview]) \
+            -> Optional[ApplicationProtocol]:
+        for protocol in self.protocols:
+            if protocol.is_protocol_packet(packet):
+                return protocol
+        return None
+
+    def can_pass_through(self) -> bool:
+        """Whether no byte of this tunnel has to be seen by Python anymore.
 
-                else:
-                    self.active = False
+        Wrapped sockets (protocol_depth > 0) are never relayed, their data
+        has to be de- and encrypted."""
+        return all((
+            self.passthrough,
+            self.writer is None,
+            self.protocol_depth == 0,
+            self.inspected or self.maximum_protocol_depth == 0,
+        ))
 
-        self.server.get_real_socket().close()
+    async def park_server_to_client(self, state: TunnelState) -> bool:
+        """Switches to state and waits until the server to client task
+        stopped using the sockets.
 
+        :return: False if the tunnel was closed meanwhile.
+        """
+        self.server_parked.clear()
+        self.handoff_done.clear()
+        self.state = state
+        self.server.interrupt_wait()
+
+        await self.server_parked.wait()
+        return self.state != TunnelState.CLOSED
+
+    async def handoff(self, protocol: ApplicationProtocol, packet: bytes):
+        """Wraps both sockets with the given protocol.
+
+        The server to client task is parked first, so wrap_connection() is
+        the only user of the sockets."""
+        if not await self.park_server_to_client(TunnelState.HANDOFF):
+            return
+
+        self.client, self.server = await protocol.wrap_connection(
+            packet,
+            self.client,
+            self.server,
+            self.loop
+        )
+
+        self.protocol_depth += 1
+        self.state = TunnelState.FORWARDING
+        self.handoff_done.set()
+
+    async def pass_through(self):
+        """Relays both directions in the kernel until one side closes.
+
+        The server to client task stays parked until the tunnel is closed."""
+        if not await self.park_server_to_client(TunnelState.PASSTHROUGH):
+            return
+
+        await relay(self.client.get_real_socket(),
+                    self.server.get_real_socket(), self.loop)
 
     @staticmethod
     def new_pcap_name(source: str, dest: str) -> Path:
+        """Name of the capture file of a connection, relative to the capture
+        directory.
+
+        The files are spread over directories by day, hour and a hash of
+        the name (256 per hour), so no directory gets too large to list."""
+        now = time()
         rel_name = (
-            f"{str(time()).replace('.', '-')}"
-            f" "
+            f"{str(now).replace('.', '-')}"
+            f"_"
             f"{source.replace(':','-')}"
-            f" "
+            f"_"
             f"{dest.replace(':','-')}"
             f".pcap"
         )
+        shard = f"{crc32(rel_name.encode()) & 0xff:02x}"
 
-        return Path(PCAP_PATH).joinpath(rel_name)
+        return Path(strftime("%Y-%m-%d", localtime(now)),
+                    strftime("%H", localtime(now)), shard, rel_name)
 
     @staticmethod
     def ip_to_ipv6(ip: str) -> str:
@@ -3,7 +3,7 @@ import ipaddress
 
 def is_ipv4(candidate: str) -> bool:
     try:
-        ipaddress.IPv4Address(str)
+        ipaddress.IPv4Address(candidate)
     except ipaddress.AddressValueError:
         return False
     else:
@@ -12,7 +12,7 @@ def is_ipv4(candidate: str) -> bool:
 
 def is_ipv6(candidate: str) -> bool:
     try:
-        ipaddress.IPv6Address(str)
+        ipaddress.IPv6Address(candidate)
     except ipaddress.AddressValueError:
         return False
     else:
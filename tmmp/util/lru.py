@@ -0,0 +1,68 @@
+"""
+Bounded mapping which evicts the least recently used entries.
+"""
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LruCache(Generic[K, V]):
+    """
+    Keeps at most maxsize entries and counts hits and misses of get().
+
+    on_evict is called with the key and value of each evicted entry (not for
+    deleted ones), e.g. to close them.
+    """
+    maxsize: int
+    hits: int
+    misses: int
+
+    def __init__(self, maxsize: int = 1024,
+                 on_evict: Optional[Callable[[K, V], None]] = None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.entries: "OrderedDict[K, V]" = OrderedDict()
+
+    def get(self, key: K) -> Optional[V]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def peek(self, key: K) -> Optional[V]:
+        """Like get(), but neither counted nor marked as used."""
+        return self.entries.get(key)
+
+    def __setitem__(self, key: K, value: V):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            evicted = self.entries.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(*evicted)
+
+    def __delitem__(self, key: K):
+        del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,100 @@
+"""
+Public suffixes (like "com" or "co.uk"), below which anyone can register a
+domain.
+
+The rules are in the format of https://publicsuffix.org/list/. Without a list
+file, only a few common suffixes with more than one label are known, every
+other top level domain is a public suffix by the default rule.
+"""
+import ipaddress
+
+from typing import Iterable, Optional, Set
+
+DEFAULT_RULES = (
+    # Countries with second level registrations
+    "ac.uk", "co.uk", "gov.uk", "ltd.uk", "me.uk", "net.uk", "org.uk",
+    "plc.uk", "sch.uk",
+    "com.au", "edu.au", "gov.au", "net.au", "org.au",
+    "ac.jp", "co.jp", "go.jp", "ne.jp", "or.jp",
+    "co.nz", "net.nz", "org.nz",
+    "com.br", "net.br", "org.br",
+    "com.cn", "gov.cn", "net.cn", "org.cn",
+    "com.hk", "com.sg", "com.tw", "com.tr", "com.mx", "com.ar",
+    "co.il", "co.in", "net.in", "org.in", "co.kr", "co.za",
+    # Hosting providers handing out subdomains
+    "appspot.com", "azurewebsites.net", "blogspot.com", "cloudfront.net",
+    "firebaseapp.com", "github.io", "herokuapp.com", "netlify.app",
+    "pages.dev", "s3.amazonaws.com", "vercel.app", "web.app", "workers.dev",
+)
+
+
+class PublicSuffixList:
+    rules: Set[str]
+    # Rules starting with "!", without it.
+    exceptions: Set[str]
+
+    def __init__(self, rules: Iterable[str] = DEFAULT_RULES):
+        self.rules = set()
+        self.exceptions = set()
+
+        for rule in rules:
+            rule = rule.strip().lower()
+            if not rule or rule.startswith("//"):
+                continue
+
+            # Only the first word of a line is the rule.
+            rule = rule.split()[0]
+            if rule.startswith("!"):
+                self.exceptions.add(rule[1:])
+            else:
+                self.rules.add(rule)
+
+    @classmethod
+    def from_file(cls, filename: Optional[str] = None) -> "PublicSuffixList":
+        """Loads a public_suffix_list.dat, or the default rules without a
+        filename."""
+        if filename is None:
+            return cls()
+
+        with open(filename, encoding="utf-8") as file:
+            return cls(file)
+
+    def public_suffix(self, hostname: str) -> str:
+        """Returns the longest public suffix of hostname."""
+        labels = hostname.lower().strip(".").split(".")
+
+        for i in range(len(labels)):
+            candidate = ".".join(labels[i:])
+            if candidate in self.exceptions:
+                return ".".join(labels[i + 1:])
+            if candidate in self.rules or \
+                    "*." + ".".join(labels[i + 1:]) in self.rules:
+                return candidate
+
+        return labels[-1]
+
+    def is_public_suffix(self, hostname: str) -> bool:
+        return self.public_suffix(hostname) == hostname.lower().strip(".")
+
+    def wildcard_name(self, hostname: str) -> str:
+        """Returns "*.parent" for hostname, if a certificate for it may
+        cover its siblings. Otherwise the hostname is returned, e.g. for
+        "example.co.uk" (a certificate for "*.co.uk" would be valid for
+        domains of anyone)."""
+        labels = hostname.split(".")
+        if len(labels) < 3 or labels[0] == "*" or _is_ip_address(hostname):
+            return hostname
+
+        parent = ".".join(labels[1:])
+        if self.is_public_suffix(parent):
+            return hostname
+        return "*." + parent
+
+
+def _is_ip_address(candidate: str) -> bool:
+    try:
+        ipaddress.ip_address(candidate)
+    except ValueError:
+        return False
+    else:
+        return True
@@ -0,0 +1,34 @@
+"""
+Helpers to build SSL contexts.
+"""
+import os
+
+from ssl import SSLContext
+from tempfile import NamedTemporaryFile
+from typing import Union
+
+HAS_MEMFD = hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd")
+
+
+def load_cert_chain_from_memory(ctx: SSLContext, certificate: bytes,
+                                key: bytes,
+                                password: Union[str, bytes, None] = None):
+    """Loads a PEM certificate (chain) and key, which are only in memory.
+
+    The ssl module can only load them from a path. On Linux that is an
+    anonymous memory file, elsewhere a temporary file which is removed right
+    after loading."""
+    if HAS_MEMFD:
+        fd = os.memfd_create("tmmp-certificate", os.MFD_CLOEXEC)
+        try:
+            os.write(fd, certificate + key)
+            path = f"/proc/self/fd/{fd}"
+            ctx.load_cert_chain(path, path, password)
+        finally:
+            os.close(fd)
+        return
+
+    with NamedTemporaryFile("wb") as file:
+        file.write(certificate + key)
+        file.flush()
+        ctx.load_cert_chain(file.name, file.name, password)